@@ -28,6 +28,30 @@ class ADHydroChannelOutputViewer(TethysAppBase):
                     UrlMap(name='get_adhydro_reach_hydrograph_ajax',
                            url='adhydro-streamflow/map/adhydro-get-hydrograph',
                            controller='adhydro_streamflow.controllers_ajax.adhydro_get_hydrograph'),
+                    UrlMap(name='get_adhydro_reach_hydrographs_ajax',
+                           url='adhydro-streamflow/map/adhydro-get-hydrographs',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_get_hydrographs'),
+                    UrlMap(name='adhydro_get_network_snapshot_ajax',
+                           url='adhydro-streamflow/map/adhydro-get-network-snapshot',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_get_network_snapshot'),
+                    UrlMap(name='adhydro_get_network_frames_ajax',
+                           url='adhydro-streamflow/map/adhydro-get-network-frames',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_get_network_frames'),
+                    UrlMap(name='adhydro_get_reach_stats_ajax',
+                           url='adhydro-streamflow/map/adhydro-get-reach-stats',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_get_reach_stats'),
+                    UrlMap(name='adhydro_get_exceedances_ajax',
+                           url='adhydro-streamflow/map/adhydro-get-exceedances',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_get_exceedances'),
+                    UrlMap(name='adhydro_compare_forecasts_ajax',
+                           url='adhydro-streamflow/map/adhydro-compare-forecasts',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_compare_forecasts'),
+                    UrlMap(name='adhydro_get_segmented_hydrograph_ajax',
+                           url='adhydro-streamflow/map/adhydro-get-segmented-hydrograph',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_get_segmented_hydrograph'),
+                    UrlMap(name='adhydro_tail_hydrograph_ajax',
+                           url='adhydro-streamflow/map/adhydro-tail-hydrograph',
+                           controller='adhydro_streamflow.controllers_ajax.adhydro_tail_hydrograph'),
                     UrlMap(name='adhydro_get_avaialable_dates_ajax',
                            url='adhydro-streamflow/map/adhydro-get-avaialable-dates',
                            controller='adhydro_streamflow.controllers_ajax.adhydro_get_avaialable_dates'),
@@ -37,6 +61,9 @@ class ADHydroChannelOutputViewer(TethysAppBase):
                     UrlMap(name='update_settings_ajax',
                            url='adhydro-streamflow/settings/update',
                            controller='adhydro_streamflow.controllers_ajax.settings_update'),
+                    UrlMap(name='hydrograph_cache_stats_ajax',
+                           url='adhydro-streamflow/settings/hydrograph-cache-stats',
+                           controller='adhydro_streamflow.controllers_ajax.hydrograph_cache_stats'),
                     UrlMap(name='add-watershed',
                            url='adhydro-streamflow/add-watershed',
                            controller='adhydro_streamflow.controllers.add_watershed'),
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Benchmarks for reading hydrographs out of ADHydro prediction files.
+
+chunk-cache: times sequential clicks along a river (reads of the whole
+hydrograph of neighbouring reaches) with the netCDF4 default chunk cache
+and with the cache sized by chunk_cache.py.
+
+readers: times the reader backends of readers.py on synthetic
+ADHydro-shaped files, as written by the model and after ingest.
+"""
+import argparse
+import netCDF4 as NET
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+#local imports
+from chunk_cache import (configure_chunk_cache, get_reach_axis, DEFAULT_CHUNK_CACHE_COLUMNS,
+                         DEFAULT_CHUNK_CACHE_MB)
+from ingest import ingest_prediction_file
+
+
+def time_sequential_reach_reads(prediction_file, first_reach, num_clicks, chunk_cache_mb=None,
+                                chunk_cache_columns=DEFAULT_CHUNK_CACHE_COLUMNS):
+    """
+    Reads the hydrographs of num_clicks neighbouring reaches from one open
+    dataset. The chunk cache is left at the netCDF4 default if
+    chunk_cache_mb is None. Returns the read times in milliseconds.
+    """
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        if chunk_cache_mb is not None:
+            configure_chunk_cache(data_nc, chunk_cache_mb * 1048576, chunk_cache_columns)
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        reach_axis = get_reach_axis(data_nc)
+        num_reaches = depth_variable.shape[reach_axis]
+        read_times = []
+        for reach_index in range(first_reach, min(num_reaches, first_reach + num_clicks)):
+            start = time.time()
+            if reach_axis == 0:
+                depth_variable[reach_index, :]
+            else:
+                depth_variable[:, reach_index]
+            read_times.append((time.time() - start) * 1000.0)
+        return read_times
+    finally:
+        data_nc.close()
+
+def benchmark_chunk_cache(prediction_file, first_reach=0, num_clicks=50,
+                          chunk_cache_mb=DEFAULT_CHUNK_CACHE_MB,
+                          chunk_cache_columns=DEFAULT_CHUNK_CACHE_COLUMNS):
+    """
+    Prints the time of sequential clicks with the default and tuned cache
+    """
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        print("%s: shape %s, chunks %s, default cache %s" %
+              (prediction_file, depth_variable.shape, depth_variable.chunking(),
+               depth_variable.get_var_chunk_cache()))
+    finally:
+        data_nc.close()
+    #warm the OS page cache so both runs read from memory
+    time_sequential_reach_reads(prediction_file, first_reach, num_clicks)
+    for label, cache_mb in (("default", None), ("tuned", chunk_cache_mb)):
+        read_times = time_sequential_reach_reads(prediction_file, first_reach, num_clicks,
+                                                 cache_mb, chunk_cache_columns)
+        print("%-8s %d clicks: total %.1f ms, first %.1f ms, mean of the rest %.2f ms" %
+              (label, len(read_times), sum(read_times), read_times[0],
+               sum(read_times[1:]) / max(1, len(read_times) - 1)))
+
+def write_synthetic_prediction_file(prediction_file, num_times, num_reaches):
+    """
+    Writes an ADHydro-shaped file: time-major depths chunked one output
+    step per chunk like the model output, with some fill values
+    """
+    data_nc = NET.Dataset(prediction_file, mode="w", format="NETCDF4")
+    try:
+        data_nc.createDimension('instances', None)
+        data_nc.createDimension('channelElements', num_reaches)
+        data_nc.createVariable('referenceDate', 'f8', ('instances',))[:num_times] = 2457000.5
+        data_nc.createVariable('currentTime', 'f8', ('instances',))[:] = \
+            np.arange(num_times) * 3600.0
+        depth_variable = data_nc.createVariable('channelSurfacewaterDepth', 'f4',
+                                                ('instances', 'channelElements'),
+                                                chunksizes=(1, num_reaches),
+                                                fill_value=NET.default_fillvals['f4'])
+        random_state = np.random.RandomState(0)
+        for time_start in range(0, num_times, 1000):
+            depths = random_state.gamma(2.0, 0.5, (min(1000, num_times - time_start),
+                                                   num_reaches)).astype(np.float32)
+            depths[depths > 4.0] = NET.default_fillvals['f4']
+            depth_variable[time_start:time_start + len(depths), :] = depths
+    finally:
+        data_nc.close()
+
+def _import_readers():
+    #readers use the app settings, so they are imported from the installed app
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tethys_apps.settings")
+    from tethys_apps.tethysapp.adhydro_streamflow import dataset_pool, readers
+    return dataset_pool, readers
+
+def time_reader(readers, reader, prediction_file, reach_batches):
+    """
+    Returns the mean time in milliseconds to read each batch of reaches
+    """
+    #open the handles and load the time axis before timing
+    readers.read_forecast_depths(prediction_file, reach_batches[0], reader=reader)
+    start = time.time()
+    for reach_indices in reach_batches:
+        readers.read_forecast_depths(prediction_file, reach_indices, reader=reader)
+    return (time.time() - start) * 1000.0 / len(reach_batches)
+
+def benchmark_readers(num_times=5000, num_reaches=2000, num_reads=20, batch_size=10):
+    """
+    Prints the read times of each reader backend for single hydrographs
+    and batches of reaches, before and after ingest
+    """
+    dataset_pool, readers = _import_readers()
+    work_directory = tempfile.mkdtemp()
+    try:
+        prediction_file = os.path.join(work_directory, "RapidResult_20150101T0000Z_CF.nc")
+        write_synthetic_prediction_file(prediction_file, num_times, num_reaches)
+        random_state = np.random.RandomState(1)
+        single_reaches = [[reach_index] for reach_index in
+                          random_state.randint(0, num_reaches, num_reads)]
+        reach_batches = [random_state.randint(0, num_reaches, batch_size).tolist()
+                         for read in range(num_reads)]
+        print("Synthetic file: %d time steps x %d reaches, %.1f MB" %
+              (num_times, num_reaches, os.path.getsize(prediction_file) / 1048576.0))
+        for stage in ("model output", "after ingest"):
+            if stage == "after ingest":
+                ingest_prediction_file(prediction_file, raw_arrays=True)
+            print(stage)
+            for name in sorted(readers.READERS):
+                reader = readers.READERS[name]
+                print("  %-8s 1 reach %8.2f ms   %d reaches %8.2f ms" %
+                      (name, time_reader(readers, reader, prediction_file, single_reaches),
+                       batch_size, time_reader(readers, reader, prediction_file, reach_batches)))
+    finally:
+        dataset_pool.invalidate_pooled_datasets(work_directory)
+        shutil.rmtree(work_directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks ADHydro hydrograph reads.")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    chunk_cache_parser = subparsers.add_parser('chunk-cache',
+                                               help="Default vs tuned HDF5 chunk cache")
+    chunk_cache_parser.add_argument('prediction_file',
+                                    help="RapidResult_*_CF.nc file or reach sidecar")
+    chunk_cache_parser.add_argument('--first-reach', type=int, default=0)
+    chunk_cache_parser.add_argument('--clicks', type=int, default=50)
+    chunk_cache_parser.add_argument('--chunk-cache-mb', type=float,
+                                    default=DEFAULT_CHUNK_CACHE_MB)
+    chunk_cache_parser.add_argument('--chunk-cache-columns', type=int,
+                                    default=DEFAULT_CHUNK_CACHE_COLUMNS)
+    readers_parser = subparsers.add_parser('readers',
+                                           help="Reader backends on synthetic files")
+    readers_parser.add_argument('--times', type=int, default=5000)
+    readers_parser.add_argument('--reaches', type=int, default=2000)
+    readers_parser.add_argument('--reads', type=int, default=20)
+    readers_parser.add_argument('--batch-size', type=int, default=10)
+    args = parser.parse_args()
+    if args.benchmark == 'readers':
+        benchmark_readers(args.times, args.reaches, args.reads, args.batch_size)
+    elif args.benchmark == 'chunk-cache':
+        benchmark_chunk_cache(args.prediction_file, args.first_reach, args.clicks,
+                              args.chunk_cache_mb, args.chunk_cache_columns)
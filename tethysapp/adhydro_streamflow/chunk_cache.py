@@ -0,0 +1,59 @@
+"""
+Sizing of the HDF5 chunk cache of channelSurfacewaterDepth.
+
+netCDF4 gives each variable a small chunk cache, so reading one reach
+across many chunks evicts chunks before the next reach can use them and
+neighbouring reaches decompress the same chunks again. The cache is
+sized to hold the chunks that a few reach reads touch.
+"""
+DEFAULT_CHUNK_CACHE_MB = 32
+#reach reads (chunk columns) to keep in the cache
+DEFAULT_CHUNK_CACHE_COLUMNS = 4
+#fraction of a partly read chunk that may still be evicted first
+CHUNK_CACHE_PREEMPTION = 0.75
+
+
+def get_reach_axis(data_nc):
+    """
+    Returns the axis of channelSurfacewaterDepth along the reaches
+    (the reach-major sidecar stores reaches first)
+    """
+    return 0 if getattr(data_nc, 'adhydro_sidecar', None) == 'reach_major' else 1
+
+def get_chunk_cache_size(depth_variable, reach_axis, max_bytes,
+                         columns=DEFAULT_CHUNK_CACHE_COLUMNS):
+    """
+    Returns the chunk cache size in bytes and number of hash slots that
+    hold the chunks touched by reading the given number of reaches
+    (at most max_bytes) or None if the variable is not chunked
+    """
+    chunking = depth_variable.chunking()
+    if chunking == 'contiguous':
+        return None
+    chunk_bytes = depth_variable.dtype.itemsize
+    chunks_per_reach = 1
+    for axis, (dimension_size, chunk_size) in enumerate(zip(depth_variable.shape, chunking)):
+        chunk_bytes *= chunk_size
+        if axis != reach_axis:
+            chunks_per_reach *= -(-dimension_size // chunk_size)
+    #always room for at least one chunk
+    cache_bytes = max(chunk_bytes, min(max_bytes, chunk_bytes * chunks_per_reach * columns))
+    #HDF5 suggests about 100 hash slots per cached chunk, and an odd count
+    nelems = max(521, 100 * (cache_bytes // chunk_bytes)) | 1
+    return int(cache_bytes), int(nelems)
+
+def configure_chunk_cache(data_nc, max_bytes=DEFAULT_CHUNK_CACHE_MB * 1048576,
+                          columns=DEFAULT_CHUNK_CACHE_COLUMNS):
+    """
+    Sets the chunk cache of channelSurfacewaterDepth in the open dataset.
+    Returns the cache size and slots or None if it was not changed.
+    """
+    depth_variable = data_nc.variables.get('channelSurfacewaterDepth')
+    if depth_variable is None:
+        return None
+    cache_size = get_chunk_cache_size(depth_variable, get_reach_axis(data_nc),
+                                      max_bytes, columns)
+    if cache_size is not None:
+        depth_variable.set_var_chunk_cache(size=cache_size[0], nelems=cache_size[1],
+                                           preemption=CHUNK_CACHE_PREEMPTION)
+    return cache_size
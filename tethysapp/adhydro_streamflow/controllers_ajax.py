@@ -1,6 +1,7 @@
 from crontab import CronTab
 import datetime
 from glob import glob
+from itertools import chain
 import netCDF4 as NET
 import numpy as np
 import os
@@ -8,7 +9,7 @@ from shutil import move
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import ObjectDeletedError
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 import jdcal
 import time
 
@@ -20,6 +21,7 @@ from tethys_dataset_services.engines import (GeoServerSpatialDatasetEngine,
                                              CkanDatasetEngine)
 
 #local imports
+from dataset_pool import get_file_fingerprint, invalidate_pooled_datasets, pooled_dataset
 from functions import (check_shapefile_input_files,
                        rename_shapefile_input_files,
                        delete_old_watershed_prediction_files,
@@ -30,9 +32,32 @@ from functions import (check_shapefile_input_files,
                        adhydro_find_most_current_file,
                        format_name,
                        get_cron_command,
+                       find_recent_forecast_files,
+                       get_forecast_cache_control,
                        get_reach_index, 
+                       get_reach_sidecar,
                        handle_uploaded_file, 
-                       user_permission_test)
+                       user_permission_test,
+                       CachedRequest)
+from exceedance import find_exceedances, load_block_maxima
+from forecast_catalog import find_forecast_files
+from forecast_comparison import (align_time_axes, read_forecast_hydrographs,
+                                 MAX_COMPARISON_FORECASTS)
+from hydrograph import (encode_base64, get_base64_series, get_binary_series,
+                        get_columnar_series, get_depth_range, get_frame_numbers,
+                        get_quantization_scale, get_time_axis, get_time_index,
+                        get_time_slice, get_time_value_pairs, lttb_downsample,
+                        mask_missing, parse_time_parameter, quantize_values,
+                        read_frame_block, FRAME_BLOCK_SIZE, HYDROGRAPH_FORMATS,
+                        QUANTIZATION_DTYPES)
+from hydrograph_cache import invalidate_cached_responses, HYDROGRAPH_CACHE
+from reach_index import load_reach_index
+from readers import read_forecast_depths
+from reach_stats import load_reach_stats, rank_reaches, REACH_STATS_FIELDS
+from segments import (get_segment_files_version, get_segmented_run_directory,
+                      load_segment_index, read_segmented_hydrograph)
+from utilities import get_app_setting
+from live_tail import get_tail_delta, iter_tail_events, wait_for_records
 
 from model import (DataStore, Geoserver, MainSettings, SettingsSessionMaker,
                     Watershed, WatershedGroup)
@@ -347,90 +372,695 @@ def adhydro_get_avaialable_dates(request):
         if not os.path.exists(path_to_watershed_files):
             return JsonResponse({'error' : 'ADHydro forecast for %s (%s) not found.' % (watershed_name, subbasin_name) })
 
-        prediction_files = sorted([d for d in os.listdir(path_to_watershed_files) \
-                                if not os.path.isdir(os.path.join(path_to_watershed_files, d))],
-                                reverse=True)
+        #newest forecasts from the catalog (limit number of directories)
+        forecast_files = find_forecast_files(path_to_watershed_files, 65)
+        #files copied in place do not change the folder, so the list is
+        #versioned by the catalog entries it is built from
+        catalog_version = tuple((forecast_file.date_string, forecast_file.mtime, forecast_file.size)
+                                for forecast_file in forecast_files)
+        last_modified = max([os.path.getmtime(path_to_watershed_files)] +
+                            [mtime for _, mtime, _ in catalog_version])
+        cached_request = CachedRequest(request, 'available_dates', path_to_watershed_files,
+                                       version=catalog_version, last_modified=last_modified)
+        response = cached_request.get_response()
+        if response is not None:
+            return response
+
         output_files = []
-        directory_count = 0
-        for prediction_file in prediction_files:
-            date_string = prediction_file.split("_")[1]
+        for forecast_file in forecast_files:
+            date_string = forecast_file.date_string
 #            date = datetime.datetime.strptime(date_string,"%Y%m%dT%H%MZ")
             date = 0
-            path_to_file = os.path.join(path_to_watershed_files, prediction_file)
-            if os.path.exists(path_to_file):
-                output_files.append({
-                    'id' : date_string,
-                    'text' : str(date)
-                })
-                directory_count += 1
-                #limit number of directories
-                if(directory_count>64):
-                    break
+            output_files.append({
+                'id' : date_string,
+                'text' : str(date)
+            })
         if len(output_files)>0:
-            return JsonResponse({
+            return cached_request.cache(JsonResponse({
                         "success" : "File search complete!",
                         "output_files" : output_files,
-                    })
+                    }))
         else:
             return JsonResponse({'error' : 'Recent ADHydro forecasts for %s (%s) not found.' % (watershed_name, subbasin_name)})
 
+def find_adhydro_subbasin_directory(get_info):
+    """""
+    Finds the folder of the watershed and subbasin of the request.
+    Returns the path to the folder, the watershed name, the subbasin
+    name and an error message.
+    """""
+    #Query DB for path to rapid output
+    session = SettingsSessionMaker()
+    main_settings  = session.query(MainSettings).order_by(MainSettings.id).first()
+    session.close()
+    path_to_rapid_output = main_settings.adhydro_prediction_directory
+    if not os.path.exists(path_to_rapid_output):
+        return None, None, None, 'Location of ADHydro RAPID output files faulty. Please check settings.'
+
+    watershed_name = format_name(get_info['watershed_name']) if 'watershed_name' in get_info else None
+    subbasin_name = format_name(get_info['subbasin_name']) if 'subbasin_name' in get_info else None
+    if not watershed_name or not subbasin_name:
+        return None, None, None, 'ADHydro AJAX request input faulty.'
+    path_to_output_files = os.path.join(path_to_rapid_output, watershed_name, subbasin_name)
+    return path_to_output_files, watershed_name, subbasin_name, None
+
+def find_adhydro_forecast_file(get_info):
+    """""
+    Finds the forecast file for the watershed, subbasin and date_string
+    of the request. Returns the path to the file and an error message.
+    """""
+    path_to_output_files, watershed_name, subbasin_name, error = \
+        find_adhydro_subbasin_directory(get_info)
+    if error:
+        return None, error
+    date_string = get_info.get('date_string')
+    if not date_string:
+        return None, 'ADHydro AJAX request input faulty.'
+    #find/check current output datasets
+    #20150405T2300Z
+    forecast_file = adhydro_find_most_current_file(path_to_output_files, date_string)
+    if not forecast_file:
+        return None, 'ADHydro forecast for %s (%s) not found.' % (watershed_name, subbasin_name)
+    return forecast_file, None
+
+def get_time_window(get_info):
+    """""
+    Gets the start/end times (epoch ms or ISO time) of the request.
+    Returns the start time, end time and an error message.
+    """""
+    try:
+        start_time = parse_time_parameter(get_info['start']) if get_info.get('start') else None
+        end_time = parse_time_parameter(get_info['end']) if get_info.get('end') else None
+    except ValueError as ex:
+        return None, None, 'ADHydro time window faulty. %s' % ex
+    return start_time, end_time, None
+
 def adhydro_get_hydrograph(request):
     """""
     Returns ADHydro hydrograph
     """""
-    #TODO: UPDATE
     if request.method == 'GET':
-        #Query DB for path to rapid output
-        session = SettingsSessionMaker()
-        main_settings  = session.query(MainSettings).order_by(MainSettings.id).first()
-        session.close()
-        path_to_rapid_output = main_settings.adhydro_prediction_directory
-        if not os.path.exists(path_to_rapid_output):
-            return JsonResponse({'error' : 'Location of ADHydro RAPID output files faulty. Please check settings.'})
-
         #get information from GET request
         get_info = request.GET
-        watershed_name = format_name(get_info['watershed_name']) if 'watershed_name' in get_info else None
-        subbasin_name = format_name(get_info['subbasin_name']) if 'subbasin_name' in get_info else None
         reach_id = get_info.get('reach_id')
-        date_string = get_info.get('date_string')
-        if not reach_id or not watershed_name or not subbasin_name or not date_string:
+        if not reach_id:
             return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
-        #find/check current output datasets
-        #20150405T2300Z
-        path_to_output_files = os.path.join(path_to_rapid_output, watershed_name, subbasin_name)
-        forecast_file = adhydro_find_most_current_file(path_to_output_files, date_string)
-        if not forecast_file:
-            return JsonResponse({'error' : 'ADHydro forecast for %s (%s) not found.' % (watershed_name, subbasin_name)})
+        max_points, start_time, end_time, response_format, error = \
+            get_hydrograph_options(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        forecast_file, error = find_adhydro_forecast_file(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        #answer repeat requests without opening the file
+        cached_request = CachedRequest(request, 'hydrograph', forecast_file,
+                                       (reach_id, str(start_time), str(end_time),
+                                        response_format, max_points),
+                                       get_forecast_cache_control(get_info.get('date_string')))
+        response = cached_request.get_response()
+        if response is not None:
+            return response
         #get/check the index of the reach
         reach_index = get_reach_index(reach_id, forecast_file)
         if reach_index == None:
-            return JsonResponse({'error' : 'ADHydro reach with id: %s not found.' % reach_id})
-
-        #get information from dataset
-        data_nc = NET.Dataset(forecast_file, mode="r")
+            return JsonResponse({'error' : 'ADHydro reach with id: %s not found.' % reach_id},
+                                status=404)
+        #use the arrays built at ingest if available (handles are reused across requests)
         try:
-            data_values = data_nc.variables['channelSurfacewaterDepth'][:,reach_index]
-            jul_date = data_nc.variables['referenceDate'][0]
-            ref_date = jdcal.jd2gcal(jul_date,0)
-            ref_date_time = datetime.datetime(ref_date[0],ref_date[1],ref_date[2],int(ref_date[3]*24))
-            ref_time_utc = time.mktime(ref_date_time.timetuple())
+            time_ms, data_values = read_forecast_depths(forecast_file, [reach_index],
+                                                        start_time, end_time)
+            data_values = data_values[:,0]
         except:
-            data_nc.close()
             return JsonResponse({'error' : "Invalid ADHydro forecast file"})
 
-        variables = data_nc.variables.keys()
-        if 'currentTime' in variables:
-            timeout = [(t+ref_time_utc)*1000 for t in data_nc.variables['currentTime'][:]]
+        return build_hydrograph_response(cached_request, time_ms, data_values, response_format,
+                                         max_points)
+
+def build_hydrograph_response(cached_request, time_ms, data_values, response_format, max_points,
+                              extra_fields=None):
+    """""
+    Downsamples the hydrograph to max_points and builds the cached
+    response of the request in the requested format. extra_fields are
+    added to JSON responses.
+    """""
+    #downsample long runs to what the chart can display
+    num_points = len(data_values)
+    decimated = max_points is not None and num_points > max_points
+    if decimated:
+        kept_indices = lttb_downsample(time_ms, data_values, max_points)
+        time_ms = time_ms[kept_indices]
+        data_values = data_values[kept_indices]
+
+    if response_format == 'binary':
+        body, headers = get_binary_series(time_ms, data_values)
+        response = HttpResponse(body, content_type='application/octet-stream')
+        for header, value in headers.items():
+            response[header] = value
+        response['X-ADHydro-Decimated'] = str(decimated).lower()
+        response['X-ADHydro-Original-Points'] = str(num_points)
+        return cached_request.cache(response, list(headers) + ['X-ADHydro-Decimated',
+                                                               'X-ADHydro-Original-Points'])
+
+    if response_format == 'columnar':
+        adhydro_series = get_columnar_series(time_ms, data_values)
+    elif response_format == 'base64':
+        adhydro_series = get_base64_series(time_ms, data_values)
+    else:
+        adhydro_series = get_time_value_pairs(time_ms, data_values)
+    response_fields = {
+        "success" : "ADHydro data analysis complete!",
+        "adhydro" : adhydro_series,
+        "format" : response_format,
+        "decimated" : decimated,
+        "original_points" : num_points,
+    }
+    response_fields.update(extra_fields or {})
+    return cached_request.cache(JsonResponse(response_fields))
+
+def get_hydrograph_options(get_info):
+    """""
+    Gets the max_points, start/end times and format of a hydrograph
+    request. Returns them and an error message.
+    """""
+    try:
+        max_points = int(get_info['max_points']) if get_info.get('max_points') else None
+    except ValueError:
+        return None, None, None, None, 'ADHydro max_points must be an integer.'
+    if max_points is not None and max_points < 3:
+        return None, None, None, None, 'ADHydro max_points must be at least 3.'
+    start_time, end_time, error = get_time_window(get_info)
+    if error:
+        return None, None, None, None, error
+    response_format = get_info.get('format') or 'pairs'
+    if response_format not in HYDROGRAPH_FORMATS:
+        return None, None, None, None, 'ADHydro format must be one of: %s.' % ", ".join(HYDROGRAPH_FORMATS)
+    return max_points, start_time, end_time, response_format, None
+
+def adhydro_get_segmented_hydrograph(request):
+    """""
+    Returns the ADHydro hydrograph of a reach across the segments of a
+    segmented run
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        reach_id = get_info.get('reach_id')
+        run_name = format_name(get_info['run_name']) if 'run_name' in get_info else None
+        if not reach_id or not run_name:
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
+        max_points, start_time, end_time, response_format, error = \
+            get_hydrograph_options(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        path_to_output_files, watershed_name, subbasin_name, error = \
+            find_adhydro_subbasin_directory(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        run_directory = get_segmented_run_directory(path_to_output_files, run_name)
+        if not run_directory:
+            return JsonResponse({'error' : 'ADHydro run %s for %s (%s) not found.' % (run_name, watershed_name, subbasin_name)})
+
+        #only the segments that overlap the time window are read
+        try:
+            segment_files = load_segment_index(run_directory).get_segment_files(start_time,
+                                                                                end_time)
+        except Exception:
+            return JsonResponse({'error' : "Invalid ADHydro run segments"})
+        if not segment_files:
+            return JsonResponse({'error' : 'ADHydro run %s has no output in the time window.' % run_name})
+        #the run can still be growing, so responses are always revalidated
+        cached_request = CachedRequest(request, 'segmented_hydrograph', run_directory,
+                                       (reach_id, str(start_time), str(end_time),
+                                        response_format, max_points),
+                                       source_paths=segment_files)
+        response = cached_request.get_response()
+        if response is not None:
+            return response
+
+        time_ms, data_values, missing_files = read_segmented_hydrograph(segment_files, reach_id,
+                                                                        start_time, end_time)
+        if len(missing_files) == len(segment_files):
+            return JsonResponse({'error' : 'ADHydro reach with id: %s not found.' % reach_id},
+                                status=404)
+        return build_hydrograph_response(cached_request, time_ms, data_values, response_format,
+                                         max_points, {
+                "segments" : len(segment_files),
+                "missing_segments" : [os.path.basename(path) for path in missing_files],
+        })
+
+def adhydro_tail_hydrograph(request):
+    """""
+    Sends the records a running model appends to the hydrograph of a reach
+    as server-sent events (mode=sse, default) or answers a long-poll
+    request with them (mode=poll)
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        reach_id = get_info.get('reach_id')
+        mode = get_info.get('mode') or 'sse'
+        run_name = format_name(get_info['run_name']) if get_info.get('run_name') else None
+        if not reach_id or mode not in ('sse', 'poll'):
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
+        #a reconnecting EventSource sends the last output step it received
+        after = request.META.get('HTTP_LAST_EVENT_ID') or get_info.get('after')
+        poll_seconds = float(get_app_setting('TAIL_POLL_SECONDS', 5))
+        max_seconds = float(get_app_setting('TAIL_MAX_SECONDS', 300))
+        try:
+            last_time = parse_time_parameter(after) if after else None
+            timeout = min(float(get_info.get('timeout') or 25), max_seconds)
+        except ValueError:
+            return JsonResponse({'error' : 'ADHydro after and timeout must be times and seconds.'})
+
+        if run_name:
+            path_to_output_files, watershed_name, subbasin_name, error = \
+                find_adhydro_subbasin_directory(get_info)
+            if error:
+                return JsonResponse({'error' : error})
+            run_directory = get_segmented_run_directory(path_to_output_files, run_name)
+            if not run_directory:
+                return JsonResponse({'error' : 'ADHydro run %s for %s (%s) not found.' % (run_name, watershed_name, subbasin_name)})
+            def get_version():
+                return get_segment_files_version(run_directory)
+            def read_records(start_time):
+                try:
+                    segment_files = load_segment_index(run_directory).get_segment_files(start_time)
+                    time_ms, data_values, missing_files = \
+                        read_segmented_hydrograph(segment_files, reach_id, start_time)
+                finally:
+                    #HDF5 file locks would stop the model from reopening the files
+                    invalidate_pooled_datasets(run_directory)
+                return time_ms, data_values
+        else:
+            forecast_file, error = find_adhydro_forecast_file(get_info)
+            if error:
+                return JsonResponse({'error' : error})
+            reach_index = get_reach_index(reach_id, forecast_file)
+            if reach_index == None:
+                return JsonResponse({'error' : 'ADHydro reach with id: %s not found.' % reach_id},
+                                    status=404)
+            def get_version():
+                return get_file_fingerprint(forecast_file)
+            def read_records(start_time):
+                try:
+                    time_ms, data_values = read_forecast_depths(forecast_file, [reach_index],
+                                                                start_time)
+                finally:
+                    #HDF5 file locks would stop the model from reopening the file
+                    invalidate_pooled_datasets(forecast_file)
+                return time_ms, data_values[:,0]
+
+        if mode == 'poll':
+            time_ms, data_values = wait_for_records(read_records, get_version, last_time,
+                                                    poll_seconds, max(0.0, timeout))
+            response_fields = get_tail_delta(time_ms, data_values)
+            response_fields.update({
+                "success" : "ADHydro tail complete!",
+                "reach_id" : reach_id,
+                #send back as after with the next request
+                "last_time" : int(time_ms[-1]) if len(time_ms) else
+                              (None if last_time is None else int(last_time.astype(np.int64))),
+            })
+            response = JsonResponse(response_fields)
         else:
-            data_nc.close()
+            response = StreamingHttpResponse(iter_tail_events(read_records, get_version, last_time,
+                                                              poll_seconds, max_seconds),
+                                             content_type='text/event-stream')
+            #stop nginx from buffering the events
+            response['X-Accel-Buffering'] = 'no'
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+def adhydro_get_hydrographs(request):
+    """""
+    Returns ADHydro hydrographs for multiple reaches on one time axis
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        reach_ids = get_info.getlist('reach_ids[]') or \
+            [reach_id for reach_id in get_info.get('reach_ids', '').split(',') if reach_id]
+        if not reach_ids:
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
+        start_time, end_time, error = get_time_window(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        forecast_file, error = find_adhydro_forecast_file(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        #answer repeat requests without opening the file
+        cached_request = CachedRequest(request, 'hydrographs', forecast_file,
+                                       (tuple(reach_ids), str(start_time), str(end_time)),
+                                       get_forecast_cache_control(get_info.get('date_string')))
+        response = cached_request.get_response()
+        if response is not None:
+            return response
+        #get/check the index of the reaches
+        reach_indices = []
+        for reach_id in reach_ids:
+            reach_index = get_reach_index(reach_id, forecast_file)
+            if reach_index == None:
+                return JsonResponse({'error' : 'ADHydro reach with id: %s not found.' % reach_id},
+                                    status=404)
+            reach_indices.append(reach_index)
+        #use the arrays built at ingest if available
+        try:
+            time_ms, data_values = read_forecast_depths(forecast_file, reach_indices,
+                                                        start_time, end_time)
+        except:
             return JsonResponse({'error' : "Invalid ADHydro forecast file"})
-        data_nc.close()
 
-        return JsonResponse({
+        return cached_request.cache(JsonResponse({
                 "success" : "ADHydro data analysis complete!",
-                "adhydro" : zip(timeout, data_values.tolist()),
-        })
+                "reach_ids" : reach_ids,
+                "time" : time_ms.tolist(),
+                "adhydro" : mask_missing(data_values).T.tolist(),
+        }))
+
+def adhydro_get_network_snapshot(request):
+    """""
+    Returns the quantized depth of every reach at one time step
+    for styling the drainage lines
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        try:
+            snapshot_time = parse_time_parameter(get_info['time']) if get_info.get('time') else None
+            bits = int(get_info.get('bits') or 8)
+        except ValueError as ex:
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty. %s' % ex})
+        if bits not in QUANTIZATION_DTYPES:
+            return JsonResponse({'error' : 'ADHydro bits must be 8 or 16.'})
+        forecast_file, error = find_adhydro_forecast_file(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        #answer repeat requests without opening the file
+        cached_request = CachedRequest(request, 'network_snapshot', forecast_file,
+                                       (str(snapshot_time), bits),
+                                       get_forecast_cache_control(get_info.get('date_string')))
+        response = cached_request.get_response()
+        if response is not None:
+            return response
+
+        #a time step is one contiguous row of the time-major output
+        with pooled_dataset(forecast_file) as data_nc:
+            try:
+                time_axis = get_time_axis(data_nc)
+                time_index = get_time_index(time_axis, snapshot_time)
+                data_values = data_nc.variables['channelSurfacewaterDepth'][time_index, :]
+            except:
+                return JsonResponse({'error' : "Invalid ADHydro forecast file"})
+
+        codes, offset, scale = quantize_values(data_values, bits)
+        reach_ids = load_reach_index(forecast_file).get_reach_ids()
+        reach_ids_dtype = '<i4' if len(reach_ids) == 0 or \
+            (reach_ids.min() >= -2**31 and reach_ids.max() < 2**31) else '<i8'
+        return cached_request.cache(JsonResponse({
+                "success" : "ADHydro network snapshot complete!",
+                "time" : int(time_axis[time_index].astype(np.int64)),
+                "time_index" : time_index,
+                "bits" : bits,
+                "dtype" : QUANTIZATION_DTYPES[bits],
+                "offset" : offset,
+                "scale" : scale,
+                "missing_code" : 2 ** bits - 1,
+                "values" : encode_base64(codes, QUANTIZATION_DTYPES[bits]),
+                "reach_ids_dtype" : reach_ids_dtype,
+                "reach_ids" : encode_base64(reach_ids, reach_ids_dtype),
+        }))
+
+def adhydro_get_reach_stats(request):
+    """""
+    Returns the per-reach depth statistics built at ingest for one reach
+    or the reaches ranked by a statistic
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        reach_id = get_info.get('reach_id')
+        sort_by = get_info.get('sort_by') or 'maximum'
+        try:
+            limit = int(get_info.get('limit') or 100)
+        except ValueError:
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
+        if sort_by not in REACH_STATS_FIELDS:
+            return JsonResponse({'error' : 'ADHydro sort_by must be one of: %s.' %
+                                 ', '.join(REACH_STATS_FIELDS)})
+        forecast_file, error = find_adhydro_forecast_file(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        #answer repeat requests without opening the file
+        cached_request = CachedRequest(request, 'reach_stats', forecast_file,
+                                       (reach_id, sort_by, limit),
+                                       get_forecast_cache_control(get_info.get('date_string')))
+        response = cached_request.get_response()
+        if response is not None:
+            return response
+
+        reach_stats = load_reach_stats(forecast_file)
+        if reach_stats is None:
+            return JsonResponse({'error' : 'ADHydro reach statistics not found. '
+                                           'Run the ingest step for this forecast.'})
+        reach_index = load_reach_index(forecast_file)
+        if reach_id:
+            position = reach_index.get_index(reach_id)
+            if position is None:
+                return JsonResponse({'error' : 'ADHydro reach %s not found.' % reach_id},
+                                    status=404)
+            positions = np.array([position])
+        else:
+            positions = rank_reaches(reach_stats[sort_by], limit)
+
+        with pooled_dataset(forecast_file) as data_nc:
+            time_axis = get_time_axis(data_nc)
+        peak_time_index = reach_stats['peak_time_index'][positions]
+        peak_time = np.ma.masked_array(time_axis[np.maximum(peak_time_index, 0)].astype(np.int64),
+                                       mask=peak_time_index < 0)
+        reach_stats_response = {
+            "success" : "ADHydro reach statistics found!",
+            "reach_ids" : reach_index.get_reach_ids()[positions].tolist(),
+            "peak_time" : peak_time.tolist(),
+            "percentile_levels" : reach_stats['percentile_levels'].tolist(),
+            "percentiles" : np.ma.masked_invalid(
+                reach_stats['percentiles'][positions].astype(np.float64)).tolist(),
+        }
+        for name in REACH_STATS_FIELDS:
+            reach_stats_response[name] = np.ma.masked_invalid(
+                reach_stats[name][positions].astype(np.float64)).tolist()
+        return cached_request.cache(JsonResponse(reach_stats_response))
+
+def adhydro_get_exceedances(request):
+    """""
+    Returns the reaches with a depth above the threshold in the time
+    window with the time of the first exceedance and the peak depth
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        try:
+            threshold = float(get_info['threshold'])
+        except (KeyError, ValueError):
+            return JsonResponse({'error' : 'ADHydro threshold faulty.'})
+        start_time, end_time, error = get_time_window(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        forecast_file, error = find_adhydro_forecast_file(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        #answer repeat requests without opening the file
+        cached_request = CachedRequest(request, 'exceedances', forecast_file,
+                                       (repr(threshold), str(start_time), str(end_time)),
+                                       get_forecast_cache_control(get_info.get('date_string')))
+        response = cached_request.get_response()
+        if response is not None:
+            return response
+
+        block_maxima = load_block_maxima(forecast_file)
+        if block_maxima is None:
+            return JsonResponse({'error' : 'ADHydro block maxima not found. '
+                                           'Run the ingest step for this forecast.'})
+        #refine reads of a few reaches are contiguous in the reach-major sidecar
+        sidecar_file = get_reach_sidecar(forecast_file)
+        with pooled_dataset(sidecar_file or forecast_file) as data_nc:
+            try:
+                time_axis = get_time_axis(data_nc)
+                positions, first_time_indices, peak_depths = \
+                    find_exceedances(data_nc, block_maxima[0], block_maxima[1],
+                                     get_time_slice(time_axis, start_time, end_time),
+                                     threshold, reach_major=bool(sidecar_file))
+            except:
+                return JsonResponse({'error' : "Invalid ADHydro forecast file"})
+
+        #earliest exceedances first
+        order = np.lexsort((-peak_depths, first_time_indices))
+        return cached_request.cache(JsonResponse({
+                "success" : "ADHydro exceedances found!",
+                "threshold" : threshold,
+                "reach_ids" : load_reach_index(forecast_file).get_reach_ids()[positions[order]].tolist(),
+                "first_exceedance_time" : time_axis[first_time_indices[order]].astype(np.int64).tolist(),
+                "peak" : peak_depths[order].tolist(),
+        }))
+
+def adhydro_compare_forecasts(request):
+    """""
+    Returns the hydrograph of a reach from several forecasts on one time axis
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        reach_id = get_info.get('reach_id')
+        if not reach_id:
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
+        date_strings = get_info.get('date_strings')
+        date_strings = [date_string for date_string in date_strings.split(',') if date_string] \
+            if date_strings else get_info.getlist('date_strings[]')
+        try:
+            count = int(get_info.get('count') or 10)
+        except ValueError:
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
+        start_time, end_time, error = get_time_window(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+
+        #the latest forecast locates the subbasin folder
+        forecast_file, error = find_adhydro_forecast_file(dict(get_info.items(),
+                                                               date_string='most_recent'))
+        if error:
+            return JsonResponse({'error' : error})
+        path_to_output_files = os.path.dirname(forecast_file)
+        if date_strings:
+            forecast_files = [os.path.join(path_to_output_files, "RapidResult_%s_CF.nc" % date_string)
+                              for date_string in date_strings[:MAX_COMPARISON_FORECASTS]]
+            forecast_files = [path for path in forecast_files if os.path.exists(path)]
+        else:
+            forecast_files = find_recent_forecast_files(path_to_output_files,
+                                                        max(1, min(count, MAX_COMPARISON_FORECASTS)))
+        if not forecast_files:
+            return JsonResponse({'error' : 'ADHydro forecasts to compare not found.'})
+
+        #answer repeat requests without opening the files
+        cached_request = CachedRequest(request, 'forecast_comparison', path_to_output_files,
+                                       (reach_id, str(start_time), str(end_time)),
+                                       get_forecast_cache_control(None if date_strings
+                                                                  else 'most_recent'),
+                                       source_paths=forecast_files)
+        response = cached_request.get_response()
+        if response is not None:
+            return response
+
+        #forecasts with a raw array are read without taking turns on the HDF5 lock
+        hydrographs = read_forecast_hydrographs(forecast_files, reach_id, start_time, end_time)
+        found_date_strings = [os.path.basename(path).split("_")[1]
+                              for path, hydrograph in zip(forecast_files, hydrographs)
+                              if hydrograph is not None]
+        if not found_date_strings:
+            return JsonResponse({'error' : 'ADHydro reach with id: %s not found.' % reach_id},
+                                status=404)
+        time_ms, aligned_values = align_time_axes([hydrograph for hydrograph in hydrographs
+                                                   if hydrograph is not None])
+        return cached_request.cache(JsonResponse({
+                "success" : "ADHydro forecast comparison complete!",
+                "reach_id" : reach_id,
+                "time" : time_ms.tolist(),
+                "forecasts" : [{"date_string" : date_string, "values" : values.tolist()}
+                               for date_string, values in zip(found_date_strings, aligned_values)],
+                "missing" : [os.path.basename(path).split("_")[1]
+                             for path, hydrograph in zip(forecast_files, hydrographs)
+                             if hydrograph is None],
+        }))
+
+def iter_network_frames(forecast_file, fingerprint, frame_numbers, stride, bits,
+                        depth_range, frame_bytes):
+    """""
+    Yields the quantized frames block by block. Encoded blocks are cached
+    per (file, stride, bits) so later requests only copy bytes.
+    """""
+    for block_number in np.unique(frame_numbers // FRAME_BLOCK_SIZE):
+        block_start = block_number * FRAME_BLOCK_SIZE
+        cache_key = (fingerprint, 'network_frames', stride, bits, int(block_number))
+        entry = HYDROGRAPH_CACHE.get(cache_key)
+        if entry is not None:
+            block = entry[0]
+        else:
+            #stop rather than mix frames of a file replaced mid-stream
+            if get_file_fingerprint(forecast_file) != fingerprint:
+                return
+            with pooled_dataset(forecast_file) as data_nc:
+                data_values = read_frame_block(data_nc, block_number, stride)
+            block = quantize_values(data_values, bits, depth_range)[0].tobytes()
+            HYDROGRAPH_CACHE.set(cache_key, block, 'application/octet-stream', ())
+        block_frames = frame_numbers[(frame_numbers >= block_start) &
+                                     (frame_numbers < block_start + FRAME_BLOCK_SIZE)]
+        yield block[(block_frames[0] - block_start) * frame_bytes:
+                    (block_frames[-1] - block_start + 1) * frame_bytes]
+
+def adhydro_get_network_frames(request):
+    """""
+    Streams the quantized depth of every reach for a range of time steps
+    as binary animation frames
+    """""
+    if request.method == 'GET':
+        #get information from GET request
+        get_info = request.GET
+        try:
+            stride = int(get_info.get('stride') or 1)
+            bits = int(get_info.get('bits') or 8)
+        except ValueError:
+            return JsonResponse({'error' : 'ADHydro AJAX request input faulty.'})
+        if stride < 1:
+            return JsonResponse({'error' : 'ADHydro stride must be a positive integer.'})
+        if bits not in QUANTIZATION_DTYPES:
+            return JsonResponse({'error' : 'ADHydro bits must be 8 or 16.'})
+        start_time, end_time, error = get_time_window(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        forecast_file, error = find_adhydro_forecast_file(get_info)
+        if error:
+            return JsonResponse({'error' : error})
+        #answer repeat requests without opening the file (frames are cached per block)
+        cached_request = CachedRequest(request, 'network_frames', forecast_file,
+                                       cache_control=get_forecast_cache_control(
+                                           get_info.get('date_string')))
+        response = cached_request.get_not_modified_response()
+        if response is not None:
+            return response
+        fingerprint = get_file_fingerprint(forecast_file)
+
+        with pooled_dataset(forecast_file) as data_nc:
+            try:
+                time_axis = get_time_axis(data_nc)
+                num_reaches = data_nc.variables['channelSurfacewaterDepth'].shape[1]
+            except:
+                return JsonResponse({'error' : "Invalid ADHydro forecast file"})
+        #one scale for the whole file so frames are comparable
+        depth_range = get_depth_range(forecast_file)
+        if depth_range is None:
+            return JsonResponse({'error' : 'ADHydro reach statistics not found. '
+                                           'Run the ingest step for this forecast.'})
+
+        frame_numbers = get_frame_numbers(get_time_slice(time_axis, start_time, end_time), stride)
+        frame_times = time_axis[frame_numbers * stride].astype('<i8').tobytes()
+        frame_bytes = num_reaches * np.dtype(QUANTIZATION_DTYPES[bits]).itemsize
+        offset, scale = get_quantization_scale(depth_range, bits)
+        #the frame times come first so the client can label each frame
+        streaming_content = [frame_times]
+        if len(frame_numbers):
+            streaming_content = chain(streaming_content,
+                                      iter_network_frames(forecast_file, fingerprint,
+                                                          frame_numbers, stride, bits,
+                                                          depth_range, frame_bytes))
+        #no Content-Length, so the frames are sent with chunked transfer
+        response = StreamingHttpResponse(streaming_content,
+                                         content_type='application/octet-stream')
+        response['X-ADHydro-Frames'] = str(len(frame_numbers))
+        response['X-ADHydro-Reaches'] = str(num_reaches)
+        response['X-ADHydro-Bits'] = str(bits)
+        response['X-ADHydro-Offset'] = repr(offset)
+        response['X-ADHydro-Scale'] = repr(scale)
+        response['X-ADHydro-Missing-Code'] = str(2 ** bits - 1)
+        response['X-ADHydro-Times-Bytes'] = str(len(frame_times))
+        return cached_request.send(response)
 
 @user_passes_test(user_permission_test)
 def settings_update(request):
@@ -468,6 +1098,9 @@ def settings_update(request):
         #update main settings
         main_settings  = session.query(MainSettings).order_by(MainSettings.id).first()
         main_settings.base_layer_id = base_layer_id
+        if main_settings.adhydro_prediction_directory != adhydro_prediction_directory:
+            #cached hydrographs belong to the old prediction directory
+            invalidate_cached_responses()
         main_settings.adhydro_prediction_directory = adhydro_prediction_directory    
         main_settings.base_layer.api_key = api_key
         session.commit()
@@ -475,6 +1108,18 @@ def settings_update(request):
 
         return JsonResponse({ 'success': "Settings Sucessfully Updated!" })
 
+@user_passes_test(user_permission_test)
+def hydrograph_cache_stats(request):
+    """
+    Controller for the hydrograph cache counters.
+    """
+    if request.method == 'GET':
+        return JsonResponse({
+                "success" : "Cache statistics retrieved!",
+                "hydrograph_cache" : HYDROGRAPH_CACHE.get_stats(),
+        })
+    return JsonResponse({ 'error': "A problem with your request exists." })
+
 @user_passes_test(user_permission_test)    
 def watershed_add(request):
     """
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Converts ADHydro output (display.nc or state.nc) into a viewer file.
+
+Copies referenceDate, currentTime and channelSurfacewaterDepth (and the
+reach ids if the output has them) into a compressed
+RapidResult_<date>_CF.nc file in the subbasin folder of the ADHydro
+prediction directory, then builds its sidecar files. This replaces the
+manual "ncks -v referenceDate,currentTime,channelSurfacewaterDepth" step.
+"""
+import argparse
+import datetime
+import netCDF4 as NET
+import os
+#local imports
+from ingest import ingest_prediction_file, DEFAULT_INGEST_MEMORY_MB, REACH_ID_VARIABLES
+
+VIEWER_VARIABLES = ('referenceDate', 'currentTime', 'channelSurfacewaterDepth')
+#largest time chunk of the viewer file
+MAX_VIEWER_TIME_CHUNK = 1024
+#target size of a viewer file chunk
+VIEWER_CHUNK_BYTES = 262144
+VIEWER_COMPLEVEL = 4
+
+
+def get_forecast_date_string(adhydro_nc):
+    """
+    Returns the date string (e.g. 20150405T2300Z) of the first output step
+    """
+    jul_date = float(adhydro_nc.variables['referenceDate'][0])
+    current_time = float(adhydro_nc.variables['currentTime'][0])
+    forecast_date = datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(days=jul_date - 2440587.5, seconds=current_time)
+    #round to the minute
+    forecast_date += datetime.timedelta(seconds=30)
+    return forecast_date.strftime("%Y%m%dT%H%MZ")
+
+def get_viewer_chunks(num_times, num_reaches, item_size, memory_mb):
+    """
+    Returns the (time, reach) chunk sizes of the viewer file. Chunks span
+    many time steps of a few reaches so that hydrograph reads touch few
+    chunks, and a whole row of chunks fits in memory_mb.
+    """
+    time_chunk = memory_mb * 1048576 // (item_size * max(1, num_reaches))
+    time_chunk = max(1, min(num_times, MAX_VIEWER_TIME_CHUNK, time_chunk))
+    reach_chunk = max(1, min(num_reaches, VIEWER_CHUNK_BYTES // (item_size * time_chunk)))
+    return time_chunk, reach_chunk
+
+def copy_variable(adhydro_nc, viewer_nc, variable_name, **create_options):
+    """
+    Creates the variable and its dimensions in the viewer file
+    """
+    source_variable = adhydro_nc.variables[variable_name]
+    for dimension_name, dimension_size in zip(source_variable.dimensions, source_variable.shape):
+        if dimension_name not in viewer_nc.dimensions:
+            viewer_nc.createDimension(dimension_name, dimension_size)
+    viewer_variable = viewer_nc.createVariable(variable_name, source_variable.dtype,
+                                               source_variable.dimensions,
+                                               fill_value=getattr(source_variable,
+                                                                  '_FillValue', None),
+                                               **create_options)
+    viewer_variable.setncatts(dict((name, source_variable.getncattr(name))
+                                   for name in source_variable.ncattrs()
+                                   if name != '_FillValue'))
+    source_variable.set_auto_mask(False)
+    return source_variable, viewer_variable
+
+def convert_adhydro_output(adhydro_file, subbasin_directory, date_string=None,
+                           memory_mb=DEFAULT_INGEST_MEMORY_MB, build_sidecars=True):
+    """
+    Writes the viewer file of the ADHydro output into the subbasin folder.
+    channelSurfacewaterDepth is streamed in blocks of time steps that fit
+    in memory_mb. Returns the path to the viewer file.
+    """
+    adhydro_nc = NET.Dataset(adhydro_file, mode="r")
+    try:
+        missing_variables = [name for name in VIEWER_VARIABLES if name not in adhydro_nc.variables]
+        if missing_variables:
+            raise ValueError("%s is missing %s" % (adhydro_file, ", ".join(missing_variables)))
+        date_string = date_string or get_forecast_date_string(adhydro_nc)
+        if not os.path.exists(subbasin_directory):
+            os.makedirs(subbasin_directory)
+        viewer_file = os.path.join(subbasin_directory, "RapidResult_%s_CF.nc" % date_string)
+        #write next to the destination so the rename is atomic
+        temp_file = "%s.tmp%s" % (viewer_file, os.getpid())
+
+        viewer_nc = NET.Dataset(temp_file, mode="w", format="NETCDF4")
+        try:
+            for variable_name in ('referenceDate', 'currentTime'):
+                source_variable, viewer_variable = copy_variable(adhydro_nc, viewer_nc,
+                                                                 variable_name)
+                viewer_variable[:] = source_variable[:]
+
+            depth_variable = adhydro_nc.variables['channelSurfacewaterDepth']
+            reach_dimension = depth_variable.dimensions[1]
+            for variable_name in REACH_ID_VARIABLES:
+                variable = adhydro_nc.variables.get(variable_name)
+                if variable is not None and variable.dimensions == (reach_dimension,):
+                    source_variable, viewer_variable = copy_variable(adhydro_nc, viewer_nc,
+                                                                     variable_name)
+                    viewer_variable[:] = source_variable[:]
+
+            num_times, num_reaches = depth_variable.shape
+            time_chunk, reach_chunk = get_viewer_chunks(num_times, num_reaches,
+                                                        depth_variable.dtype.itemsize, memory_mb)
+            source_variable, viewer_variable = copy_variable(adhydro_nc, viewer_nc,
+                                                             'channelSurfacewaterDepth',
+                                                             zlib=True, complevel=VIEWER_COMPLEVEL,
+                                                             shuffle=True,
+                                                             chunksizes=(time_chunk, reach_chunk))
+            #whole rows of chunks so no chunk is compressed twice
+            for time_start in range(0, num_times, time_chunk):
+                viewer_variable[time_start:time_start + time_chunk, :] = \
+                    source_variable[time_start:time_start + time_chunk, :]
+            viewer_nc.close()
+        except:
+            viewer_nc.close()
+            os.remove(temp_file)
+            raise
+    finally:
+        adhydro_nc.close()
+    os.rename(temp_file, viewer_file)
+
+    if build_sidecars:
+        ingest_prediction_file(viewer_file, memory_mb)
+    return viewer_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts ADHydro output into a viewer file.")
+    parser.add_argument('adhydro_file', help="ADHydro display.nc or state.nc file")
+    parser.add_argument('subbasin_directory',
+                        help="Subbasin folder (e.g. adhydro_predictions/green_river/upper)")
+    parser.add_argument('--date-string',
+                        help="Date of the forecast, e.g. 20150405T2300Z "
+                             "(default: time of the first output step)")
+    parser.add_argument('--memory-mb', type=int, default=DEFAULT_INGEST_MEMORY_MB,
+                        help="Memory to use when copying the output")
+    parser.add_argument('--no-sidecars', action='store_true',
+                        help="Do not build the sidecar files")
+    args = parser.parse_args()
+    print("Wrote %s" % convert_adhydro_output(args.adhydro_file, args.subbasin_directory,
+                                              args.date_string, args.memory_mb,
+                                              not args.no_sidecars))
@@ -0,0 +1,272 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import netCDF4 as NET
+import os
+from threading import Lock, RLock
+#local imports
+from .chunk_cache import (configure_chunk_cache, DEFAULT_CHUNK_CACHE_COLUMNS,
+                          DEFAULT_CHUNK_CACHE_MB)
+from .utilities import get_app_setting
+
+#netCDF4 releases the GIL while it reads and HDF5 is usually not built
+#thread-safe, so every HDF5 call of the process (opening, reading and
+#closing files) is made while holding this lock. It is only held for the
+#call itself, see LockedHandle.
+HDF5_LOCK = RLock()
+#modules whose objects make HDF5 calls
+HDF5_MODULES = ('netCDF4', 'h5py')
+
+
+def get_file_fingerprint(path):
+    """
+    Returns the (path, mtime, size) key that identifies one version of a file
+    """
+    file_stat = os.stat(path)
+    return (os.path.realpath(path), file_stat.st_mtime, file_stat.st_size)
+
+
+def path_is_under(file_path, path):
+    """
+    Checks if the real file path is the path or is inside of it
+    """
+    return file_path == path or file_path.startswith(os.path.join(path, ''))
+
+
+class FingerprintCache(object):
+    """
+    Thread-safe bounded LRU of values read from a file keyed by the
+    fingerprint of the file version they were read from
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, fingerprint):
+        """
+        Returns the cached value (marking it as recently used) or None
+        """
+        with self._lock:
+            value = self._entries.pop(fingerprint, None)
+            if value is not None:
+                self._entries[fingerprint] = value
+            return value
+
+    def set(self, fingerprint, value):
+        """
+        Stores the value, evicting the least recently used ones over the limit
+        """
+        with self._lock:
+            self._entries.pop(fingerprint, None)
+            self._entries[fingerprint] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+
+def _is_hdf5_object(value):
+    return type(value).__module__.split('.')[0] in HDF5_MODULES
+
+def _wrap_hdf5_object(value):
+    #containers of variables and dimensions are wrapped so that their items are
+    if _is_hdf5_object(value) or (isinstance(value, dict) and
+                                  any(_is_hdf5_object(item) for item in value.values())):
+        return LockedHandle(value)
+    return value
+
+
+class LockedHandle(object):
+    """
+    Wraps a netCDF4 or h5py object so that every attribute access, method
+    call and item access holds HDF5_LOCK only while it runs. The netCDF4
+    and h5py objects it returns (variables, groups, attributes) are
+    wrapped too, while arrays are returned as they are. Hold HDF5_LOCK
+    around a sequence of calls that must not be interleaved with other
+    threads (e.g. set_auto_mask, read, set_auto_mask).
+    """
+    __slots__ = ('_target',)
+
+    def __init__(self, target):
+        object.__setattr__(self, '_target', target)
+
+    def __getattr__(self, name):
+        with HDF5_LOCK:
+            value = getattr(self._target, name)
+        if callable(value) and not isinstance(value, type):
+            return self._locked_call(value)
+        return _wrap_hdf5_object(value)
+
+    @staticmethod
+    def _locked_call(method):
+        def locked_method(*args, **kwargs):
+            with HDF5_LOCK:
+                return _wrap_hdf5_object(method(*args, **kwargs))
+        return locked_method
+
+    def __getitem__(self, key):
+        with HDF5_LOCK:
+            return _wrap_hdf5_object(self._target[key])
+
+    def __len__(self):
+        with HDF5_LOCK:
+            return len(self._target)
+
+    def __contains__(self, key):
+        with HDF5_LOCK:
+            return key in self._target
+
+    def __iter__(self):
+        with HDF5_LOCK:
+            items = list(self._target)
+        return iter([_wrap_hdf5_object(item) for item in items])
+
+
+def open_locked_dataset(path, mode="r"):
+    """
+    Opens a netCDF4 dataset outside of the pool (e.g. a file that is only
+    read once) as a LockedHandle
+    """
+    with HDF5_LOCK:
+        return LockedHandle(NET.Dataset(path, mode=mode))
+
+
+class PooledDataset(object):
+    """
+    Open dataset held by the dataset pool
+    """
+    def __init__(self, fingerprint, dataset):
+        self.fingerprint = fingerprint
+        self.dataset = dataset
+        self.users = 0
+        self.retired = False
+
+    def close(self):
+        try:
+            with HDF5_LOCK:
+                self.dataset.close()
+        except (RuntimeError, IOError):
+            #already closed or file removed underneath us
+            pass
+
+
+class DatasetPool(object):
+    """
+    Process-wide pool of open netCDF4 datasets with LRU eviction.
+
+    Handles are keyed by the file fingerprint, so a file that is replaced
+    on disk (e.g. by load_datasets) is reopened on the next request and
+    the handle on the old version is closed once nobody is using it.
+    Other file handles (e.g. h5py files) can be pooled by passing the
+    function that opens them.
+    """
+    def __init__(self, max_open_datasets, chunk_cache_mb=DEFAULT_CHUNK_CACHE_MB,
+                 chunk_cache_columns=DEFAULT_CHUNK_CACHE_COLUMNS, open_dataset=None):
+        self.max_open_datasets = max(1, int(max_open_datasets))
+        self.chunk_cache_bytes = int(chunk_cache_mb * 1048576)
+        self.chunk_cache_columns = max(1, int(chunk_cache_columns))
+        self.open_dataset = open_dataset or self._open_netcdf_dataset
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @contextmanager
+    def dataset(self, path):
+        """
+        Context manager yielding the open dataset for the path as a
+        LockedHandle. Handles are shared between threads, and HDF5_LOCK is
+        only held while each call into the dataset runs.
+        """
+        entry = self._acquire(path)
+        try:
+            yield LockedHandle(entry.dataset)
+        finally:
+            self._release(entry)
+
+    def invalidate(self, path=None):
+        """
+        Closes handles on the file or all files under the directory.
+        Closes every handle if no path is given.
+        """
+        if path is not None:
+            path = os.path.realpath(path)
+        with self._lock:
+            for fingerprint in list(self._entries):
+                if path is None or path_is_under(fingerprint[0], path):
+                    self._retire(self._entries.pop(fingerprint))
+
+    def _open_netcdf_dataset(self, path):
+        dataset = NET.Dataset(path, mode="r")
+        #a chunk cache of 0 MB keeps the netCDF4 default
+        if self.chunk_cache_bytes > 0:
+            configure_chunk_cache(dataset, self.chunk_cache_bytes, self.chunk_cache_columns)
+        return dataset
+
+    def _acquire(self, path):
+        fingerprint = get_file_fingerprint(path)
+        with self._lock:
+            entry = self._entries.pop(fingerprint, None)
+            if entry is None:
+                #drop handles on older versions of the same file
+                for old_fingerprint in list(self._entries):
+                    if old_fingerprint[0] == fingerprint[0]:
+                        self._retire(self._entries.pop(old_fingerprint))
+                with HDF5_LOCK:
+                    dataset = self.open_dataset(fingerprint[0])
+                entry = PooledDataset(fingerprint, dataset)
+            entry.users += 1
+            #most recently used entries live at the end
+            self._entries[fingerprint] = entry
+            self._evict()
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            if entry.retired and entry.users <= 0:
+                entry.close()
+            #the pool may have grown past its size while the handle was in use
+            self._evict()
+
+    def _retire(self, entry):
+        entry.retired = True
+        if entry.users <= 0:
+            entry.close()
+
+    def _evict(self):
+        for fingerprint in list(self._entries):
+            if len(self._entries) <= self.max_open_datasets:
+                break
+            #handles in use are evicted by _release once they are free
+            if self._entries[fingerprint].users <= 0:
+                self._retire(self._entries.pop(fingerprint))
+
+
+#pools of other file handles register here to be invalidated too
+DATASET_POOLS = []
+
+def register_dataset_pool(dataset_pool):
+    """
+    Adds the pool to the pools closed by invalidate_pooled_datasets
+    """
+    DATASET_POOLS.append(dataset_pool)
+    return dataset_pool
+
+
+DATASET_POOL = DatasetPool(get_app_setting('MAX_OPEN_DATASETS', 16),
+                           get_app_setting('CHUNK_CACHE_MB', DEFAULT_CHUNK_CACHE_MB),
+                           get_app_setting('CHUNK_CACHE_COLUMNS', DEFAULT_CHUNK_CACHE_COLUMNS))
+register_dataset_pool(DATASET_POOL)
+
+
+def pooled_dataset(path):
+    """
+    Returns a context manager yielding the pooled dataset for the path
+    """
+    return DATASET_POOL.dataset(path)
+
+
+def invalidate_pooled_datasets(path=None):
+    """
+    Closes pooled handles on the file or directory (all if no path given)
+    """
+    for dataset_pool in DATASET_POOLS:
+        dataset_pool.invalidate(path)
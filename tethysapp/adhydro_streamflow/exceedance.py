@@ -0,0 +1,99 @@
+import numpy as np
+#local imports
+from .dataset_pool import FingerprintCache, get_file_fingerprint
+from .hydrograph import read_reach_depths
+from .ingest import get_sidecar_path, sidecar_is_current, BLOCK_MAXIMA_SUFFIX
+
+BLOCK_MAXIMA_CACHE_SIZE = 16
+
+_block_maxima_cache = FingerprintCache(BLOCK_MAXIMA_CACHE_SIZE)
+
+
+def load_block_maxima(prediction_file):
+    """
+    Returns the (block, reach) maxima and block size built at ingest or
+    None if the sidecar is missing or stale. The maxima are cached per
+    version of the file.
+    """
+    fingerprint = get_file_fingerprint(prediction_file)
+    block_maxima = _block_maxima_cache.get(fingerprint)
+    if block_maxima is not None:
+        return block_maxima
+
+    sidecar_file = get_sidecar_path(prediction_file, BLOCK_MAXIMA_SUFFIX)
+    if not sidecar_is_current(sidecar_file, prediction_file):
+        return None
+    sidecar_arrays = np.load(sidecar_file)
+    try:
+        block_maxima = (sidecar_arrays['block_maxima'], int(sidecar_arrays['block_size']))
+    finally:
+        sidecar_arrays.close()
+
+    return _block_maxima_cache.set(fingerprint, block_maxima)
+
+def _read_depths(data_nc, reach_indices, reach_major, time_slice):
+    """
+    Reads the depths of the reaches with NaN for missing values
+    """
+    return np.ma.filled(np.ma.asarray(read_reach_depths(data_nc, reach_indices, reach_major,
+                                                        time_slice), dtype=np.float64), np.nan)
+
+def find_exceedances(data_nc, block_maxima, block_size, time_slice, threshold,
+                     reach_major=False):
+    """
+    Finds the reaches with a depth above the threshold in the time slice.
+    Reaches are pruned with the block maxima. Only the partial blocks at
+    the ends of the window and the first exceeding block of each reach
+    are read. Returns the reach positions, the time index of the first
+    exceedance and the peak depth in the window.
+    """
+    no_exceedances = (np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+                      np.array([], dtype=np.float64))
+    num_times = data_nc.variables['channelSurfacewaterDepth'].shape[1 if reach_major else 0]
+    start, stop = time_slice.start, min(time_slice.stop, num_times)
+    if stop <= start:
+        return no_exceedances
+    first_block, end_block = start // block_size, -(-stop // block_size)
+    with np.errstate(invalid='ignore'):
+        window_exceeds = block_maxima[first_block:end_block] > threshold
+    candidates = np.flatnonzero(window_exceeds.any(axis=0))
+    if not candidates.size:
+        return no_exceedances
+    window_maxima = block_maxima[first_block:end_block, candidates].astype(np.float64)
+    window_exceeds = window_exceeds[:, candidates]
+
+    def get_block_rows(block_number):
+        block_start = (first_block + block_number) * block_size
+        return slice(max(start, block_start), min(stop, block_start + block_size))
+
+    #the maxima of blocks cut by the window are refined with a read
+    refined_values = {}
+    for block_number in set((0, end_block - first_block - 1)):
+        block_rows = get_block_rows(block_number)
+        block_start = (first_block + block_number) * block_size
+        if block_rows == slice(block_start, min(num_times, block_start + block_size)):
+            continue
+        values = _read_depths(data_nc, candidates, reach_major, block_rows)
+        refined_values[block_number] = values
+        window_maxima[block_number] = np.fmax.reduce(values, axis=0)
+        with np.errstate(invalid='ignore'):
+            window_exceeds[block_number] = window_maxima[block_number] > threshold
+
+    exceeding = window_exceeds.any(axis=0)
+    candidates = candidates[exceeding]
+    window_exceeds = window_exceeds[:, exceeding]
+    peak_depths = np.fmax.reduce(window_maxima[:, exceeding], axis=0)
+
+    #read the first exceeding block of each reach for the exceedance time
+    first_exceeding_block = window_exceeds.argmax(axis=0)
+    first_time_indices = np.empty(len(candidates), dtype=np.int64)
+    for block_number in np.unique(first_exceeding_block):
+        in_block = np.flatnonzero(first_exceeding_block == block_number)
+        block_rows = get_block_rows(block_number)
+        if block_number in refined_values:
+            values = refined_values[block_number][:, exceeding][:, in_block]
+        else:
+            values = _read_depths(data_nc, candidates[in_block], reach_major, block_rows)
+        with np.errstate(invalid='ignore'):
+            first_time_indices[in_block] = block_rows.start + np.argmax(values > threshold, axis=0)
+    return candidates, first_time_indices, peak_depths
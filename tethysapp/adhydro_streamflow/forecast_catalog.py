@@ -0,0 +1,206 @@
+"""
+Catalog of the ADHydro prediction files.
+
+The forecast_file table holds the watershed, subbasin, date, size, time
+range and reach count of every RapidResult_*_CF.nc file, so the forecasts
+of a subbasin are found with an indexed query instead of a directory scan.
+The catalog is filled by ingest.py. Each server process also syncs a
+subbasin folder with the catalog when the folder changed since it last
+looked or had files that were still being copied, so files copied in
+without running ingest are found too. Settled files that cannot be read
+are left out until they change.
+"""
+from glob import glob
+import os
+from sqlalchemy.exc import IntegrityError
+from threading import Lock
+import time
+#local imports
+from .dataset_pool import get_file_fingerprint, open_locked_dataset
+from .ingest import get_output_time_range
+from .model import ForecastFile, SettingsSessionMaker
+
+#files modified this recently may still be being written
+CATALOG_SETTLE_SECONDS = 10
+
+#fingerprint of each subbasin folder when it was last synced completely
+_synced_folders = {}
+_synced_folders_lock = Lock()
+#(mtime, size) of settled files that could not be read by path
+_bad_files = {}
+_bad_files_lock = Lock()
+
+
+def get_forecast_date_string(prediction_file):
+    """
+    Returns the date string of the prediction file
+    (RapidResult_20150405T2300Z_CF.nc gives 20150405T2300Z)
+    """
+    return os.path.basename(prediction_file).split("_")[1]
+
+def query_subbasin_forecast_files(session, subbasin_directory):
+    """
+    Returns the query of the catalog entries of the subbasin folder
+    """
+    return session.query(ForecastFile) \
+        .filter(ForecastFile.watershed_name == os.path.basename(os.path.dirname(subbasin_directory)),
+                ForecastFile.subbasin_name == os.path.basename(subbasin_directory))
+
+def read_forecast_file(prediction_file):
+    """
+    Returns the catalog entry of the prediction file
+    (<watershed>/<subbasin>/RapidResult_*_CF.nc)
+    """
+    path = os.path.abspath(prediction_file)
+    subbasin_directory = os.path.dirname(path)
+    file_stat = os.stat(path)
+    data_nc = open_locked_dataset(path)
+    try:
+        start_time, end_time = get_output_time_range(data_nc)
+        reach_count = data_nc.variables['channelSurfacewaterDepth'].shape[1]
+    finally:
+        data_nc.close()
+    return ForecastFile(os.path.basename(os.path.dirname(subbasin_directory)),
+                        os.path.basename(subbasin_directory),
+                        get_forecast_date_string(path), path, file_stat.st_size,
+                        file_stat.st_mtime, start_time, end_time, reach_count)
+
+def sync_subbasin_catalog(session, subbasin_directory):
+    """
+    Adds the new and changed prediction files of the subbasin folder to
+    the catalog and removes the entries of files that are gone. Files that
+    cannot be read are left out, until the next sync if they may still be
+    being copied and until they change if they are settled (bad files).
+    Returns the number of entries added, updated and removed, and the
+    number of files that were left out or may still change.
+    """
+    subbasin_directory = os.path.abspath(subbasin_directory)
+    cataloged_files = dict((forecast_file.path, forecast_file) for forecast_file in
+                           query_subbasin_forecast_files(session, subbasin_directory))
+    num_changed = num_unsettled = 0
+    for prediction_file in glob(os.path.join(subbasin_directory, "RapidResult_*_CF.nc")):
+        forecast_file = cataloged_files.pop(prediction_file, None)
+        try:
+            file_stat = os.stat(prediction_file)
+        except OSError:
+            #removed since the folder was listed
+            num_unsettled += 1
+            continue
+        file_version = (file_stat.st_mtime, file_stat.st_size)
+        #a copy in progress does not change the folder, so look again
+        settled = time.time() - file_stat.st_mtime >= CATALOG_SETTLE_SECONDS
+        if not settled:
+            num_unsettled += 1
+        if forecast_file is not None and forecast_file.size == file_stat.st_size \
+            and forecast_file.mtime == file_stat.st_mtime:
+            continue
+        with _bad_files_lock:
+            bad = _bad_files.get(prediction_file) == file_version
+        if not bad:
+            try:
+                new_forecast_file = read_forecast_file(prediction_file)
+            except Exception:
+                if settled:
+                    with _bad_files_lock:
+                        _bad_files[prediction_file] = file_version
+                else:
+                    num_unsettled += 1
+                bad = True
+        if bad:
+            #an entry of an older version of the file is removed
+            if forecast_file is not None:
+                cataloged_files[prediction_file] = forecast_file
+            continue
+        if forecast_file is None:
+            session.add(new_forecast_file)
+        else:
+            for column in ('size', 'mtime', 'start_time', 'end_time', 'reach_count'):
+                setattr(forecast_file, column, getattr(new_forecast_file, column))
+        num_changed += 1
+    for forecast_file in cataloged_files.values():
+        session.delete(forecast_file)
+    try:
+        session.commit()
+    except IntegrityError:
+        #another server process added the same files
+        session.rollback()
+        num_unsettled += num_changed
+    return num_changed, len(cataloged_files), num_unsettled
+
+def update_subbasin_catalog(subbasin_directory):
+    """
+    Syncs the catalog with one subbasin folder. Returns the number of
+    entries added or updated and removed.
+    """
+    session = SettingsSessionMaker()
+    try:
+        return sync_subbasin_catalog(session, subbasin_directory)[:2]
+    finally:
+        session.close()
+
+def rescan_forecast_catalog(prediction_directory):
+    """
+    Syncs the catalog with all subbasin folders of the ADHydro prediction
+    directory and removes the entries of folders that are gone. Returns the
+    number of entries added or updated and removed.
+    """
+    session = SettingsSessionMaker()
+    try:
+        num_changed = num_removed = 0
+        for subbasin_directory in sorted(glob(os.path.join(prediction_directory, '*', '*'))):
+            if os.path.isdir(subbasin_directory):
+                changed, removed, _ = sync_subbasin_catalog(session, subbasin_directory)
+                num_changed += changed
+                num_removed += removed
+        for forecast_file in session.query(ForecastFile).all():
+            if not os.path.exists(forecast_file.path):
+                session.delete(forecast_file)
+                num_removed += 1
+        session.commit()
+        return num_changed, num_removed
+    finally:
+        session.close()
+
+def find_forecast_files(path_to_watershed_files, count=None):
+    """
+    Returns the catalog entries of the forecasts in the subbasin folder,
+    newest first. The folder is synced with the catalog first if it
+    changed since this process last synced it, or if files were still
+    being copied at the last sync.
+    """
+    if not os.path.exists(path_to_watershed_files):
+        return []
+    subbasin_directory = os.path.abspath(path_to_watershed_files)
+    fingerprint = get_file_fingerprint(subbasin_directory)
+    session = SettingsSessionMaker()
+    try:
+        with _synced_folders_lock:
+            synced = _synced_folders.get(subbasin_directory) == fingerprint
+        if not synced:
+            num_unsettled = sync_subbasin_catalog(session, subbasin_directory)[2]
+            if not num_unsettled:
+                with _synced_folders_lock:
+                    _synced_folders[subbasin_directory] = fingerprint
+        query = query_subbasin_forecast_files(session, subbasin_directory) \
+            .order_by(ForecastFile.date_string.desc())
+        if count is not None:
+            query = query.limit(count)
+        return query.all()
+    finally:
+        session.close()
+
+def remove_forecast_files(path_to_watershed_files):
+    """
+    Removes the catalog entries of the subbasin folder (e.g. after its
+    files were deleted)
+    """
+    subbasin_directory = os.path.abspath(path_to_watershed_files)
+    session = SettingsSessionMaker()
+    try:
+        query_subbasin_forecast_files(session, subbasin_directory) \
+            .delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+    with _synced_folders_lock:
+        _synced_folders.pop(subbasin_directory, None)
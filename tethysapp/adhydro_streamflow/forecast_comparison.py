@@ -0,0 +1,76 @@
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from threading import Lock
+#local imports
+from .hydrograph import mask_missing
+from .reach_index import load_reach_index
+from .readers import get_reader, read_forecast_depths
+from .utilities import get_app_setting
+
+#most forecasts compared in one request
+MAX_COMPARISON_FORECASTS = 64
+
+_comparison_pool = None
+_comparison_pool_lock = Lock()
+
+
+def get_comparison_pool():
+    """
+    Returns the bounded pool of worker threads shared by comparison
+    requests (sized by the COMPARISON_WORKERS setting)
+    """
+    global _comparison_pool
+    with _comparison_pool_lock:
+        if _comparison_pool is None:
+            _comparison_pool = ThreadPool(max(1, int(get_app_setting('COMPARISON_WORKERS', 4))))
+        return _comparison_pool
+
+def read_forecast_hydrograph(forecast_file, reach_id, start_time=None, end_time=None,
+                             reader=None):
+    """
+    Reads the hydrograph of the reach in the time window from one forecast
+    with the reader backend. Returns the times in milliseconds and the
+    depths or None if the reach is not in the forecast.
+    """
+    reach_index = load_reach_index(forecast_file).get_index(reach_id)
+    if reach_index is None:
+        return None
+    time_ms, data_values = read_forecast_depths(forecast_file, [reach_index],
+                                                start_time, end_time, reader)
+    return time_ms, data_values[:, 0]
+
+def _read_forecast_hydrograph_safe(arguments):
+    try:
+        return read_forecast_hydrograph(*arguments)
+    except Exception:
+        return None
+
+def read_forecast_hydrographs(forecast_files, reach_id, start_time=None, end_time=None):
+    """
+    Reads the hydrograph of the reach from each forecast concurrently in
+    the comparison pool. Forecasts with a raw array (ingest.py
+    --raw-arrays) are read through numpy.memmap, which needs no HDF5 lock,
+    so their reads overlap. The others are read with netCDF4, whose reads
+    take turns on the HDF5 lock. Forecasts that could not be read give
+    None.
+    """
+    return get_comparison_pool().map(_read_forecast_hydrograph_safe,
+                                     [(forecast_file, reach_id, start_time, end_time,
+                                       get_reader('memmap'))
+                                      for forecast_file in forecast_files])
+
+def align_time_axes(hydrographs):
+    """
+    Puts the hydrographs on the union of their time axes.
+    Returns the times and a masked array of depths per hydrograph
+    (masked where a forecast has no value at a time).
+    """
+    time_axes = [time_ms for time_ms, data_values in hydrographs]
+    union_time = np.unique(np.concatenate(time_axes)) if time_axes else \
+        np.array([], dtype=np.int64)
+    aligned_values = []
+    for time_ms, data_values in hydrographs:
+        aligned = np.ma.masked_all(len(union_time), dtype=np.float64)
+        aligned[np.searchsorted(union_time, time_ms)] = mask_missing(data_values)
+        aligned_values.append(aligned)
+    return union_time, aligned_values
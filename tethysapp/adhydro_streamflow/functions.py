@@ -1,15 +1,28 @@
 import datetime
 from glob import glob
+import hashlib
 import netCDF4 as NET
 import numpy as np
 import os
 import re
 from shutil import rmtree
 from sqlalchemy import and_
+#django imports
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
 #tethys imports
 from tethys_dataset_services.engines import GeoServerSpatialDatasetEngine
 #local import
+from dataset_pool import (get_file_fingerprint, invalidate_pooled_datasets,
+                          pooled_dataset)
+from ingest import (get_sidecar_path, sidecar_matches_source,
+                    REACH_SIDECAR_SUFFIX)
+from forecast_catalog import find_forecast_files, remove_forecast_files
+from hydrograph_cache import (cache_response, get_cached_response,
+                              invalidate_cached_responses)
 from model import SettingsSessionMaker, MainSettings, Watershed
+from reach_index import load_reach_index
+from utilities import get_app_setting
 #from sfpt_dataset_manager.dataset_manager import CKANDatasetManager
 
 def check_shapefile_input_files(shp_files):
@@ -49,6 +62,11 @@ def delete_old_watershed_prediction_files(watershed):
         if main_folder_name and sub_folder_name and \
         local_prediction_files_location and os.path.exists(prediciton_folder):
             
+            #close pooled handles and drop cached hydrographs of the files being removed
+            invalidate_pooled_datasets(prediciton_folder)
+            invalidate_cached_responses(prediciton_folder)
+            remove_forecast_files(prediciton_folder)
+
             #remove all prediction files from watershed/subbasin
             try:
                 rmtree(prediciton_folder)
@@ -163,10 +181,9 @@ def adhydro_find_most_current_file(path_to_watershed_files, date_string):
     Finds the current output from downscaled ADHydro forecasts
     """""
     if(date_string=="most_recent"):
-        if not os.path.exists(path_to_watershed_files):
-            return None
-        prediction_files = sorted(glob(os.path.join(path_to_watershed_files,"*.nc")),
-                                  reverse=True)
+        #newest file from the forecast catalog
+        prediction_files = [forecast_file.path for forecast_file in
+                            find_forecast_files(path_to_watershed_files, 1)]
     else:
         #RapidResult_20150405T2300Z_CF.nc
         prediction_files = ["RapidResult_%s_CF.nc" % date_string]
@@ -181,6 +198,99 @@ def adhydro_find_most_current_file(path_to_watershed_files, date_string):
     #there are no files found
     return None
 
+class CachedRequest(object):
+    """
+    Conditional and cached answers to a GET request whose response only
+    depends on its fields and the version of what it is built from: the
+    fingerprints of the source files (the owner file or folder if none
+    are given) or an explicit version such as catalog rows. The ETag and
+    the response cache key both come from that version. Cache keys start
+    with the fingerprint of the owner so that entries are invalidated
+    with its path.
+    """
+    def __init__(self, request, name, owner_path, fields=(), cache_control="no-cache",
+                 source_paths=None, version=None, last_modified=None):
+        owner_fingerprint = get_file_fingerprint(owner_path)
+        if version is None:
+            fingerprints = [get_file_fingerprint(path) for path in source_paths or [owner_path]]
+            version = tuple(fingerprints)
+            last_modified = max(fingerprint[1] for fingerprint in fingerprints)
+        elif last_modified is None:
+            last_modified = owner_fingerprint[1]
+        self.request = request
+        self.etag = '"%s"' % hashlib.md5(repr(version).encode('utf-8')).hexdigest()
+        self.last_modified = int(last_modified)
+        self.cache_control = cache_control
+        self.cache_key = (owner_fingerprint, name, version) + tuple(fields)
+
+    def get_not_modified_response(self):
+        """
+        Returns a 304 response if the client has the current version or None
+        """
+        if is_not_modified(self.request, self.etag, self.last_modified):
+            return self.send(HttpResponseNotModified())
+        return None
+
+    def get_response(self):
+        """
+        Returns the 304 or cached response or None if it has to be built
+        """
+        response = self.get_not_modified_response()
+        if response is None:
+            response = get_cached_response(self.cache_key)
+            if response is not None:
+                self.send(response)
+        return response
+
+    def cache(self, response, headers=()):
+        """
+        Caches the response (with the named headers) and sends it
+        """
+        return self.send(cache_response(self.cache_key, response, headers))
+
+    def send(self, response):
+        """
+        Adds the caching headers to the response
+        """
+        return set_cache_headers(response, self.etag, self.last_modified, self.cache_control)
+
+def find_recent_forecast_files(path_to_watershed_files, count):
+    """
+    Finds the most recent ADHydro forecast files (newest first)
+    """
+    return [forecast_file.path for forecast_file in
+            find_forecast_files(path_to_watershed_files, count)]
+
+def get_forecast_cache_control(date_string):
+    """
+    Returns the Cache-Control header for a forecast request.
+    Dated forecasts do not change, the most recent one can.
+    """
+    if date_string == "most_recent":
+        return "no-cache"
+    return "public, max-age=%s" % get_app_setting('FORECAST_CACHE_MAX_AGE', 604800)
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Checks the If-None-Match/If-Modified-Since headers of the request
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        request_etags = [request_etag.strip().replace('W/', '', 1)
+                         for request_etag in if_none_match.split(',')]
+        return etag in request_etags or '*' in request_etags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+def set_cache_headers(response, etag, last_modified, cache_control):
+    """
+    Adds the caching headers to the response
+    """
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = cache_control
+    return response
+
 def format_name(string):
     """
     Formats watershed name for code
@@ -232,19 +342,21 @@ def get_cron_command():
 
 def get_reach_index(reach_id, prediction_file):
     """
-    Gets the index of the reach from the COMID 
+    Gets the index of the reach from the COMID using the reach index
+    built at ingest (the file is only opened if there is none)
     """
-    data_nc = NET.Dataset(prediction_file, mode="r")
-#    com_ids = len(data_nc.variables['channelSurfacewaterDepth'][0])-1
-    data_nc.close()
-    try:
-        reach_index = reach_id
-#        reach_index = np.where(com_ids==int(reach_id))[0][0]
-    except Exception as ex:
-        print ex
-        reach_index = None
-        pass
-    return reach_index                
+    return load_reach_index(prediction_file).get_index(reach_id)
+
+def get_reach_sidecar(prediction_file):
+    """
+    Returns the reach-major sidecar of the prediction file if it is up to date
+    """
+    sidecar_file = get_sidecar_path(prediction_file, REACH_SIDECAR_SUFFIX)
+    if os.path.exists(sidecar_file):
+        with pooled_dataset(sidecar_file) as sidecar_nc:
+            if sidecar_matches_source(sidecar_nc, prediction_file):
+                return sidecar_file
+    return None
 
 def get_subbasin_list(file_path):
     """
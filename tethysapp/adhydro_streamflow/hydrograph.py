@@ -0,0 +1,290 @@
+import base64
+import numpy as np
+#local imports
+from .dataset_pool import FingerprintCache, get_file_fingerprint, pooled_dataset
+from .ingest import get_reference_time_ms
+from .reach_stats import load_reach_stats
+
+TIME_AXIS_CACHE_SIZE = 32
+#response formats of the hydrograph endpoint ('pairs' is the default)
+HYDROGRAPH_FORMATS = ('pairs', 'columnar', 'base64', 'binary')
+#unsigned integer types for quantized network depths by bit depth
+QUANTIZATION_DTYPES = {8 : '<u1', 16 : '<u2'}
+#frames per cached block of animation frames
+FRAME_BLOCK_SIZE = 32
+
+_time_axis_cache = FingerprintCache(TIME_AXIS_CACHE_SIZE)
+
+
+def get_time_axis(data_nc):
+    """
+    Returns the UTC time of each ADHydro output step as a datetime64[ms]
+    array. The axis is cached per version of the file.
+    """
+    fingerprint = get_file_fingerprint(data_nc.filepath())
+    time_axis = _time_axis_cache.get(fingerprint)
+    if time_axis is not None:
+        return time_axis
+
+    time_axis = read_time_axis(data_nc)
+    return _time_axis_cache.set(fingerprint, time_axis)
+
+def read_time_axis(data_nc):
+    """
+    Reads the time axis of the open dataset without the cache
+    """
+    reference_time = np.datetime64(0, 'ms') + \
+        np.timedelta64(get_reference_time_ms(data_nc), 'ms')
+    #currentTime is in seconds since the reference date
+    current_time = np.asarray(data_nc.variables['currentTime'][:], dtype=np.float64)
+    return reference_time + np.round(current_time * 1000).astype('timedelta64[ms]')
+
+def load_time_axis(prediction_file):
+    """
+    Returns the time axis of the prediction file, opening the pooled
+    dataset only if the axis is not cached
+    """
+    time_axis = _time_axis_cache.get(get_file_fingerprint(prediction_file))
+    if time_axis is not None:
+        return time_axis
+    with pooled_dataset(prediction_file) as data_nc:
+        return get_time_axis(data_nc)
+
+def parse_time_parameter(time_string):
+    """
+    Parses epoch milliseconds or an ISO 8601 UTC time into datetime64[ms].
+    Raises ValueError if the time is invalid.
+    """
+    time_string = time_string.strip()
+    try:
+        time_value = float(time_string)
+    except ValueError:
+        time_value = None
+    if time_value is not None:
+        #inf and NaN parse as floats but are not times
+        if not np.isfinite(time_value):
+            raise ValueError("Invalid time: %s" % time_string)
+        try:
+            return np.datetime64(int(time_value), 'ms')
+        except (OverflowError, ValueError):
+            raise ValueError("Invalid time: %s" % time_string)
+    if time_string.endswith('Z'):
+        time_string = time_string[:-1]
+    try:
+        return np.datetime64(time_string, 'ms')
+    except Exception:
+        raise ValueError("Invalid time: %s" % time_string)
+
+def get_time_slice(time_axis, start_time=None, end_time=None):
+    """
+    Returns the slice of the time axis between start_time and end_time
+    (inclusive) found with a binary search
+    """
+    start_index = 0 if start_time is None else \
+        int(np.searchsorted(time_axis, start_time, side='left'))
+    end_index = len(time_axis) if end_time is None else \
+        int(np.searchsorted(time_axis, end_time, side='right'))
+    return slice(start_index, max(start_index, end_index))
+
+def get_time_index(time_axis, time=None):
+    """
+    Returns the index of the last output step at or before the time
+    (the last step if no time is given)
+    """
+    if time is None:
+        return len(time_axis) - 1
+    return max(0, int(np.searchsorted(time_axis, time, side='right')) - 1)
+
+def read_reach_depths(data_nc, reach_indices, reach_major=False, time_slice=slice(None)):
+    """
+    Reads channelSurfacewaterDepth for all of the reaches in one
+    fancy-indexed read. Only the time_slice hyperslab is read.
+    Returns a (time, reach) array with the columns in the order of
+    reach_indices.
+    """
+    #netCDF4 needs sorted, unique indices for fancy indexing
+    unique_indices, column_positions = np.unique(reach_indices, return_inverse=True)
+    depth_variable = data_nc.variables['channelSurfacewaterDepth']
+    if reach_major:
+        data_values = depth_variable[unique_indices.tolist(), time_slice].T
+    else:
+        data_values = depth_variable[time_slice, unique_indices.tolist()]
+    return data_values[:, column_positions]
+
+def mask_missing(data_values):
+    """
+    Returns the values as a float64 masked array with masked or NaN
+    values masked
+    """
+    return np.ma.masked_invalid(np.ma.asarray(data_values, dtype=np.float64))
+
+def get_time_value_pairs(time_ms, data_values):
+    """
+    Returns [[time, value], ...] built without a Python loop.
+    Missing values become None.
+    """
+    return np.ma.column_stack((np.asarray(time_ms, dtype=np.float64),
+                               mask_missing(data_values))).tolist()
+
+def get_uniform_time_step(time_ms):
+    """
+    Returns the time step in milliseconds if the time axis is evenly
+    spaced, otherwise None
+    """
+    if len(time_ms) < 2:
+        return None
+    time_steps = np.diff(time_ms)
+    if np.all(time_steps == time_steps[0]):
+        return int(time_steps[0])
+    return None
+
+def get_time_axis_description(time_ms):
+    """
+    Returns start/step for an evenly spaced time axis or the times otherwise
+    """
+    time_step = get_uniform_time_step(time_ms)
+    if time_step is None:
+        return {'time' : np.asarray(time_ms, dtype=np.int64).tolist()}
+    return {'start' : int(time_ms[0]), 'step' : time_step}
+
+def get_float32_values(data_values):
+    """
+    Returns the values as little-endian float32 with NaN for missing values
+    """
+    return np.ma.filled(np.ma.asarray(data_values, dtype='<f4'), np.nan)
+
+def get_columnar_series(time_ms, data_values):
+    """
+    Returns the series as a time axis and a values array.
+    Missing values become None.
+    """
+    series = get_time_axis_description(time_ms)
+    series['values'] = mask_missing(data_values).tolist()
+    return series
+
+def get_base64_series(time_ms, data_values):
+    """
+    Returns the series as a time axis and base64 encoded float32 values
+    """
+    series = get_time_axis_description(time_ms)
+    series['dtype'] = '<f4'
+    series['values'] = base64.b64encode(get_float32_values(data_values).tobytes()).decode('ascii')
+    return series
+
+def get_binary_series(time_ms, data_values):
+    """
+    Returns the body and headers of a binary series.
+    The body is the little-endian float32 values (NaN if missing). If the
+    time axis is not evenly spaced, the body starts with the little-endian
+    int64 times in milliseconds.
+    """
+    values = get_float32_values(data_values).tobytes()
+    time_step = get_uniform_time_step(time_ms)
+    if time_step is None:
+        return (np.asarray(time_ms, dtype='<i8').tobytes() + values,
+                {'X-ADHydro-Times-Bytes' : str(8 * len(time_ms))})
+    return values, {'X-ADHydro-Start' : str(int(time_ms[0])),
+                    'X-ADHydro-Step' : str(time_step)}
+
+def lttb_downsample(time_ms, data_values, max_points):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the indices of the
+    points to keep: the first and last points and one point per bucket.
+    The highest value of the series is always kept.
+    """
+    num_points = len(data_values)
+    if max_points < 3 or max_points >= num_points:
+        return np.arange(num_points)
+    x_values = np.asarray(time_ms, dtype=np.float64)
+    y_values = np.ma.filled(np.ma.asarray(data_values, dtype=np.float64), np.nan)
+    #edges of the buckets between the first and last points
+    edges = np.linspace(1, num_points - 1, max_points - 1).astype(np.int64)
+    edges = np.append(edges, num_points)
+    indices = np.empty(max_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = num_points - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        #average point of the next bucket (the last point for the last bucket)
+        next_y = y_values[end:edges[bucket + 2]]
+        next_y = next_y[~np.isnan(next_y)]
+        next_y = next_y.mean() if next_y.size else y_values[previous]
+        next_x = x_values[end:edges[bucket + 2]].mean()
+        areas = np.abs((x_values[previous] - next_x) * (y_values[start:end] - y_values[previous]) -
+                       (x_values[previous] - x_values[start:end]) * (next_y - y_values[previous]))
+        #missing values are only picked if the bucket has nothing else
+        areas[np.isnan(areas)] = -1
+        previous = start + int(np.argmax(areas))
+        indices[bucket + 1] = previous
+
+    #make sure the peak survives
+    if not np.all(np.isnan(y_values)):
+        peak_index = int(np.nanargmax(y_values))
+        if 0 < peak_index < num_points - 1:
+            indices[np.searchsorted(edges, peak_index, side='right')] = peak_index
+    return indices
+
+def encode_base64(values, dtype):
+    """
+    Returns the values as a base64 string of the dtype
+    """
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+def get_quantization_scale(value_range, bits):
+    """
+    Returns the offset and scale that map the value range onto the codes
+    of the bit depth (the largest code is kept for missing values)
+    """
+    offset, maximum = float(value_range[0]), float(value_range[1])
+    scale = (maximum - offset) / (2 ** bits - 2) if maximum > offset else 1.0
+    return offset, scale
+
+def quantize_values(data_values, bits, value_range=None):
+    """
+    Quantizes the values to unsigned integers of the bit depth over the
+    value range (the range of the values by default). The largest code
+    marks missing values. Returns the codes, offset and scale where
+    value = offset + code * scale.
+    """
+    values = np.ma.filled(np.ma.asarray(data_values, dtype=np.float64), np.nan)
+    missing_code = 2 ** bits - 1
+    valid = np.isfinite(values)
+    if value_range is None:
+        value_range = (values[valid].min(), values[valid].max()) if valid.any() else (0.0, 0.0)
+    offset, scale = get_quantization_scale(value_range, bits)
+    codes = np.empty(values.shape, dtype=QUANTIZATION_DTYPES[bits])
+    codes.fill(missing_code)
+    codes[valid] = np.clip(np.round((values[valid] - offset) / scale), 0, missing_code - 1)
+    return codes, offset, scale
+
+def get_depth_range(prediction_file):
+    """
+    Returns the (min, max) depth over all times and reaches of the file,
+    used as the fixed scale of the animation frames, from the per-reach
+    statistics built at ingest. Returns None if they were not built.
+    """
+    reach_stats = load_reach_stats(prediction_file)
+    if reach_stats is None:
+        return None
+    minimum, maximum = reach_stats['minimum'], reach_stats['maximum']
+    has_data = ~np.isnan(maximum)
+    if not has_data.any():
+        return (0.0, 0.0)
+    return (float(minimum[has_data].min()), float(maximum[has_data].max()))
+
+def get_frame_numbers(time_slice, stride):
+    """
+    Returns the numbers of the animation frames in the time slice. Frame n
+    is output step n * stride, so frames line up between requests.
+    """
+    return np.arange(-(-time_slice.start // stride), -(-time_slice.stop // stride))
+
+def read_frame_block(data_nc, block_number, stride):
+    """
+    Reads the rows of the FRAME_BLOCK_SIZE frames in the block with one
+    strided read of the time-major output
+    """
+    time_start = block_number * FRAME_BLOCK_SIZE * stride
+    return data_nc.variables['channelSurfacewaterDepth'][
+        time_start:time_start + FRAME_BLOCK_SIZE * stride:stride, :]
@@ -0,0 +1,250 @@
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import tempfile
+from threading import local, Lock
+import time
+#django imports
+from django.http import HttpResponse
+#local imports
+from .dataset_pool import path_is_under
+from .utilities import get_app_setting
+
+
+class MemoryHydrographCache(object):
+    """
+    In-process LRU cache of serialized hydrograph responses bounded by
+    the total size of the cached bodies.
+
+    Keys start with the forecast file fingerprint, so a changed file is
+    never served from the cache.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        Returns the cached (body, content_type, headers) or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def set(self, key, body, content_type, headers):
+        """
+        Adds a response body to the cache, evicting the least recently
+        used entries to stay within the memory budget
+        """
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.current_bytes -= len(old_entry[0])
+            self._entries[key] = (body, content_type, headers)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                evicted_body = self._entries.popitem(last=False)[1][0]
+                self.current_bytes -= len(evicted_body)
+                self.evictions += 1
+
+    def invalidate(self, path=None):
+        """
+        Removes entries of the file or all files under the directory.
+        Removes everything if no path is given.
+        """
+        if path is not None:
+            path = os.path.realpath(path)
+        with self._lock:
+            for key in list(self._entries):
+                if path is None or path_is_under(key[0][0], path):
+                    self.current_bytes -= len(self._entries.pop(key)[0])
+
+    def get_stats(self):
+        """
+        Returns the cache counters
+        """
+        with self._lock:
+            return {
+                'entries' : len(self._entries),
+                'bytes' : self.current_bytes,
+                'max_bytes' : self.max_bytes,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+            }
+
+
+class SQLiteHydrographCache(object):
+    """
+    On-disk LRU cache of serialized hydrograph responses shared by all of
+    the server processes (e.g. mod_wsgi daemon processes). Same interface
+    as MemoryHydrographCache. Writes are SQLite transactions, so readers
+    never see a partial entry.
+    """
+    def __init__(self, database_path, max_bytes):
+        self.database_path = database_path
+        self.max_bytes = max(0, int(max_bytes))
+        #hit/miss/eviction counts are for this process only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = local()
+        self._lock = Lock()
+
+    def _get_connection(self):
+        #connections cannot be shared between threads or forked processes
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.database_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS hydrograph_cache ("
+                               "key TEXT PRIMARY KEY, path TEXT, body BLOB, "
+                               "content_type TEXT, headers TEXT, size INTEGER, "
+                               "last_access REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS hydrograph_cache_last_access "
+                               "ON hydrograph_cache (last_access)")
+            connection.commit()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """
+        Returns the cached (body, content_type, headers) or None
+        """
+        connection = self._get_connection()
+        row = connection.execute("SELECT body, content_type, headers FROM hydrograph_cache "
+                                 "WHERE key = ?", (repr(key),)).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        with connection:
+            connection.execute("UPDATE hydrograph_cache SET last_access = ? WHERE key = ?",
+                               (time.time(), repr(key)))
+        self._count('hits')
+        return bytes(row[0]), row[1], json.loads(row[2])
+
+    def set(self, key, body, content_type, headers):
+        """
+        Adds a response body to the cache, evicting the least recently
+        used entries to stay within the disk budget
+        """
+        if len(body) > self.max_bytes:
+            return
+        connection = self._get_connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO hydrograph_cache "
+                               "(key, path, body, content_type, headers, size, last_access) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (repr(key), key[0][0], sqlite3.Binary(body), content_type,
+                                json.dumps(list(headers)), len(body), time.time()))
+            total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) "
+                                             "FROM hydrograph_cache").fetchone()[0]
+            if total_bytes > self.max_bytes:
+                evicted_bytes = 0
+                for evicted_key, size in connection.execute(
+                        "SELECT key, size FROM hydrograph_cache ORDER BY last_access").fetchall():
+                    if total_bytes - evicted_bytes <= self.max_bytes:
+                        break
+                    connection.execute("DELETE FROM hydrograph_cache WHERE key = ?",
+                                       (evicted_key,))
+                    evicted_bytes += size
+                    self._count('evictions')
+
+    def invalidate(self, path=None):
+        """
+        Removes entries of the file or all files under the directory.
+        Removes everything if no path is given.
+        """
+        connection = self._get_connection()
+        with connection:
+            if path is None:
+                connection.execute("DELETE FROM hydrograph_cache")
+            else:
+                path = os.path.realpath(path)
+                connection.execute("DELETE FROM hydrograph_cache WHERE path = ? OR "
+                                   "substr(path, 1, ?) = ?",
+                                   (path, len(os.path.join(path, '')),
+                                    os.path.join(path, '')))
+
+    def get_stats(self):
+        """
+        Returns the cache counters
+        """
+        entries, current_bytes = self._get_connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM hydrograph_cache").fetchone()
+        with self._lock:
+            return {
+                'entries' : entries,
+                'bytes' : current_bytes,
+                'max_bytes' : self.max_bytes,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+            }
+
+
+def get_hydrograph_cache():
+    """
+    Returns the hydrograph cache backend selected in the settings
+    ('memory' for one process or 'sqlite' to share between processes)
+    """
+    max_bytes = get_app_setting('HYDROGRAPH_CACHE_MB', 64) * 1048576
+    if get_app_setting('HYDROGRAPH_CACHE_BACKEND', 'memory') == 'sqlite':
+        database_path = get_app_setting('HYDROGRAPH_CACHE_PATH',
+                                        os.path.join(tempfile.gettempdir(),
+                                                     'adhydro_streamflow_cache.sqlite'))
+        return SQLiteHydrographCache(database_path, max_bytes)
+    return MemoryHydrographCache(max_bytes)
+
+
+HYDROGRAPH_CACHE = get_hydrograph_cache()
+
+
+def get_cached_response(key):
+    """
+    Returns a response built from the cache or None on a miss
+    """
+    entry = HYDROGRAPH_CACHE.get(key)
+    if entry is None:
+        return None
+    body, content_type, headers = entry
+    response = HttpResponse(body, content_type=content_type)
+    for header, value in headers:
+        response[header] = value
+    response['X-ADHydro-Cache'] = 'hit'
+    return response
+
+def cache_response(key, response, headers=()):
+    """
+    Stores the response body and the named headers in the cache
+    """
+    HYDROGRAPH_CACHE.set(key, response.content, response['Content-Type'],
+                         tuple((header, response[header]) for header in headers
+                               if response.has_header(header)))
+    response['X-ADHydro-Cache'] = 'miss'
+    return response
+
+def invalidate_cached_responses(path=None):
+    """
+    Removes cached responses of the file or directory (all if no path given)
+    """
+    HYDROGRAPH_CACHE.invalidate(path)
@@ -0,0 +1,565 @@
+#!/usr/bin/env python
+"""
+Ingest step for ADHydro prediction files.
+
+Builds sidecar files in a "sidecars" folder next to each
+RapidResult_*_CF.nc file so that the hydrograph endpoints do not have to
+read the time-major ADHydro output directly. Segmented runs (folders of
+successive display.nc segments) also get an index of the time range of
+each segment.
+"""
+import argparse
+import errno
+from glob import glob
+import json
+import netCDF4 as NET
+import numpy as np
+import os
+
+SIDECAR_FOLDER = 'sidecars'
+REACH_SIDECAR_SUFFIX = '.reach.nc'
+REACH_INDEX_SUFFIX = '.reach_index.npz'
+REACH_STATS_SUFFIX = '.reach_stats.npz'
+#optional raw reach-major copy read through numpy.memmap and its JSON header
+REACH_ARRAY_SUFFIX = '.reach.npy'
+REACH_ARRAY_HEADER_SUFFIX = '.reach.json'
+#percentiles of the depth stored per reach
+STATS_PERCENTILES = (10, 25, 50, 75, 90)
+BLOCK_MAXIMA_SUFFIX = '.block_max.npz'
+#time steps per block of the per-reach block maxima
+BLOCK_MAXIMA_SIZE = 64
+#variables that may hold the reach ids (COMIDs) besides a coordinate variable
+REACH_ID_VARIABLES = ('COMID', 'comid')
+#largest time chunk in the reach-major sidecar (4 MB of float32)
+MAX_TIME_CHUNK = 1048576
+#target size of a reach-major sidecar chunk when runs are short
+TARGET_CHUNK_BYTES = 262144
+DEFAULT_INGEST_MEMORY_MB = 512
+#folders of successive display.nc segments of one long run and their index
+SEGMENTED_RUN_SUFFIX = '.segments'
+SEGMENT_INDEX_FILE = 'segment_index.json'
+#Julian date of 1970-01-01T00:00:00 UTC
+UNIX_EPOCH_JULIAN_DATE = 2440587.5
+
+
+def get_sidecar_path(prediction_file, suffix):
+    """
+    Returns the path to the sidecar of the prediction file with the suffix
+    """
+    prediction_directory, prediction_file_name = os.path.split(prediction_file)
+    return os.path.join(prediction_directory, SIDECAR_FOLDER,
+                        "%s%s" % (os.path.splitext(prediction_file_name)[0], suffix))
+
+def get_source_attributes(prediction_file):
+    """
+    Returns the attributes that tie a sidecar to one version of its source
+    """
+    file_stat = os.stat(prediction_file)
+    return {
+        'source_file': os.path.basename(prediction_file),
+        'source_mtime': file_stat.st_mtime,
+        'source_size': file_stat.st_size,
+    }
+
+def sidecar_matches_source(sidecar_nc, prediction_file):
+    """
+    Checks that the open sidecar was built from the current source file
+    """
+    try:
+        for name, value in get_source_attributes(prediction_file).items():
+            if sidecar_nc.getncattr(name) != value:
+                return False
+    except (AttributeError, OSError):
+        return False
+    return True
+
+def sidecar_is_current(sidecar_file, prediction_file):
+    """
+    Checks that the sidecar file exists and was built from the current
+    source file
+    """
+    if not os.path.exists(sidecar_file):
+        return False
+    if sidecar_file.endswith('.json'):
+        with open(sidecar_file) as sidecar:
+            header = json.load(sidecar)
+        return all(header.get(name) == value for name, value in
+                   get_source_attributes(prediction_file).items())
+    if sidecar_file.endswith('.npz'):
+        sidecar_arrays = np.load(sidecar_file)
+        try:
+            for name, value in get_source_attributes(prediction_file).items():
+                if name not in sidecar_arrays.files or sidecar_arrays[name][()] != value:
+                    return False
+        finally:
+            sidecar_arrays.close()
+        return True
+    sidecar_nc = NET.Dataset(sidecar_file, mode="r")
+    try:
+        return sidecar_matches_source(sidecar_nc, prediction_file)
+    finally:
+        sidecar_nc.close()
+
+def _get_temp_sidecar_path(sidecar_file):
+    """
+    Returns the temporary path to write a sidecar to before it is renamed
+    """
+    try:
+        os.makedirs(os.path.dirname(sidecar_file))
+    except OSError as ex:
+        #another ingest of the subbasin may have created it first
+        if ex.errno != errno.EEXIST:
+            raise
+    return "%s.tmp%s" % (sidecar_file, os.getpid())
+
+def _open_sidecar_output(sidecar_file):
+    """
+    Returns the temporary path and open dataset to write a sidecar to
+    """
+    temp_file = _get_temp_sidecar_path(sidecar_file)
+    return temp_file, NET.Dataset(temp_file, mode="w", format="NETCDF4")
+
+def _save_sidecar_arrays(sidecar_file, prediction_file, **arrays):
+    """
+    Atomically writes the arrays and source attributes to an .npz sidecar
+    """
+    arrays.update(get_source_attributes(prediction_file))
+    temp_file = _get_temp_sidecar_path(sidecar_file)
+    with open(temp_file, 'wb') as sidecar:
+        np.savez(sidecar, **arrays)
+    os.rename(temp_file, sidecar_file)
+    return sidecar_file
+
+def get_reach_ids(data_nc):
+    """
+    Returns the reach id (COMID) of each reach in the file. Files without
+    an id variable use the position of the reach as its id.
+    """
+    reach_dimension = data_nc.variables['channelSurfacewaterDepth'].dimensions[1]
+    for variable_name in (reach_dimension,) + REACH_ID_VARIABLES:
+        variable = data_nc.variables.get(variable_name)
+        if variable is not None and variable.dimensions == (reach_dimension,) \
+            and variable.dtype.kind in 'iu':
+            return np.asarray(variable[:], dtype=np.int64)
+    return np.arange(len(data_nc.dimensions[reach_dimension]), dtype=np.int64)
+
+def build_reach_index(prediction_file, memory_mb=DEFAULT_INGEST_MEMORY_MB):
+    """
+    Writes the sorted reach ids and the position of each reach in the file
+    so that reach ids are resolved without opening the file
+    """
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        reach_ids = get_reach_ids(data_nc)
+    finally:
+        data_nc.close()
+    reach_indices = np.argsort(reach_ids, kind='mergesort')
+    return _save_sidecar_arrays(get_sidecar_path(prediction_file, REACH_INDEX_SUFFIX),
+                                prediction_file,
+                                reach_ids=reach_ids[reach_indices],
+                                reach_indices=reach_indices)
+
+def _copy_time_variables(data_nc, sidecar_nc):
+    """
+    Copies referenceDate and currentTime into the sidecar
+    """
+    for variable_name in ('referenceDate', 'currentTime'):
+        source_variable = data_nc.variables[variable_name]
+        for dimension_name, dimension_size in zip(source_variable.dimensions,
+                                                  source_variable.shape):
+            if dimension_name not in sidecar_nc.dimensions:
+                sidecar_nc.createDimension(dimension_name, dimension_size)
+        sidecar_variable = sidecar_nc.createVariable(variable_name,
+                                                     source_variable.dtype,
+                                                     source_variable.dimensions)
+        sidecar_variable.setncatts(dict((name, source_variable.getncattr(name))
+                                        for name in source_variable.ncattrs()))
+        sidecar_variable[:] = source_variable[:]
+
+def build_reach_sidecar(prediction_file, memory_mb=DEFAULT_INGEST_MEMORY_MB):
+    """
+    Writes a reach-major (reach, time) copy of channelSurfacewaterDepth
+    so that one reach's time series is a contiguous read.
+    The source is read in blocks of reaches that fit in memory_mb.
+    """
+    sidecar_file = get_sidecar_path(prediction_file, REACH_SIDECAR_SUFFIX)
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        time_dimension, reach_dimension = depth_variable.dimensions
+        num_times, num_reaches = depth_variable.shape
+        item_size = depth_variable.dtype.itemsize
+        time_chunk = max(1, min(num_times, MAX_TIME_CHUNK))
+        reach_chunk = max(1, min(num_reaches, TARGET_CHUNK_BYTES // (item_size * time_chunk)))
+        #whole chunks of reaches per pass over the source file
+        reaches_per_block = memory_mb * 1048576 // (item_size * max(1, num_times))
+        reaches_per_block = max(reach_chunk, reaches_per_block - reaches_per_block % reach_chunk)
+
+        temp_file, sidecar_nc = _open_sidecar_output(sidecar_file)
+        try:
+            sidecar_nc.setncatts(get_source_attributes(prediction_file))
+            sidecar_nc.adhydro_sidecar = 'reach_major'
+            sidecar_nc.createDimension(time_dimension, num_times)
+            sidecar_nc.createDimension(reach_dimension, num_reaches)
+            _copy_time_variables(data_nc, sidecar_nc)
+
+            fill_value = getattr(depth_variable, '_FillValue', None)
+            sidecar_variable = sidecar_nc.createVariable('channelSurfacewaterDepth',
+                                                         depth_variable.dtype,
+                                                         (reach_dimension, time_dimension),
+                                                         zlib=True, complevel=1, shuffle=True,
+                                                         chunksizes=(reach_chunk, time_chunk),
+                                                         fill_value=fill_value)
+            sidecar_variable.setncatts(dict((name, depth_variable.getncattr(name))
+                                            for name in depth_variable.ncattrs()
+                                            if name != '_FillValue'))
+            depth_variable.set_auto_mask(False)
+            for reach_start in range(0, num_reaches, reaches_per_block):
+                reach_end = min(num_reaches, reach_start + reaches_per_block)
+                sidecar_variable[reach_start:reach_end, :] = \
+                    np.ascontiguousarray(depth_variable[:, reach_start:reach_end].T)
+            sidecar_nc.close()
+        except:
+            sidecar_nc.close()
+            os.remove(temp_file)
+            raise
+    finally:
+        data_nc.close()
+    #replace atomically so readers never see a partial sidecar
+    os.rename(temp_file, sidecar_file)
+    return sidecar_file
+
+def build_reach_stats(prediction_file, memory_mb=DEFAULT_INGEST_MEMORY_MB):
+    """
+    Writes the max, min, mean, time step of the peak and percentiles of
+    the depth of each reach. The depths are read from the reach-major
+    sidecar (built first if it is missing or stale) in blocks of whole
+    chunks of reaches that fit in memory_mb, so every chunk is read once.
+    Reaches without data get NaN and a peak time index of -1.
+    """
+    sidecar_file = get_sidecar_path(prediction_file, REACH_SIDECAR_SUFFIX)
+    if not sidecar_is_current(sidecar_file, prediction_file):
+        build_reach_sidecar(prediction_file, memory_mb)
+    sidecar_nc = NET.Dataset(sidecar_file, mode="r")
+    try:
+        depth_variable = sidecar_nc.variables['channelSurfacewaterDepth']
+        num_reaches, num_times = depth_variable.shape
+        reach_chunk = depth_variable.chunking()[0]
+        #float64 copy of the block plus the sorted copy for the percentiles
+        reaches_per_block = memory_mb * 1048576 // (16 * max(1, num_times))
+        reaches_per_block = max(reach_chunk, reaches_per_block - reaches_per_block % reach_chunk)
+        maximum = np.empty(num_reaches, dtype=np.float32)
+        minimum = np.empty(num_reaches, dtype=np.float32)
+        mean = np.empty(num_reaches, dtype=np.float32)
+        peak_time_index = np.empty(num_reaches, dtype=np.int32)
+        percentiles = np.empty((num_reaches, len(STATS_PERCENTILES)), dtype=np.float32)
+        for reach_start in range(0, num_reaches, reaches_per_block):
+            reach_end = min(num_reaches, reach_start + reaches_per_block)
+            values = np.ma.filled(np.ma.asarray(depth_variable[reach_start:reach_end, :],
+                                                dtype=np.float64), np.nan).T
+            values[~np.isfinite(values)] = np.nan
+            has_data = ~np.all(np.isnan(values), axis=0)
+            block = slice(reach_start, reach_end)
+            maximum[block] = np.nan
+            minimum[block] = np.nan
+            mean[block] = np.nan
+            peak_time_index[block] = -1
+            percentiles[block] = np.nan
+            if has_data.any():
+                values = values[:, has_data]
+                positions = np.arange(reach_start, reach_end)[has_data]
+                maximum[positions] = np.nanmax(values, axis=0)
+                minimum[positions] = np.nanmin(values, axis=0)
+                mean[positions] = np.nanmean(values, axis=0)
+                peak_time_index[positions] = np.nanargmax(values, axis=0)
+                percentiles[positions] = np.nanpercentile(values, STATS_PERCENTILES, axis=0).T
+    finally:
+        sidecar_nc.close()
+    return _save_sidecar_arrays(get_sidecar_path(prediction_file, REACH_STATS_SUFFIX),
+                                prediction_file,
+                                maximum=maximum, minimum=minimum, mean=mean,
+                                peak_time_index=peak_time_index,
+                                percentile_levels=np.array(STATS_PERCENTILES, dtype=np.float32),
+                                percentiles=percentiles)
+
+def build_block_maxima(prediction_file, memory_mb=DEFAULT_INGEST_MEMORY_MB):
+    """
+    Writes the max depth of each reach over every BLOCK_MAXIMA_SIZE time
+    steps as a (block, reach) array used to prune threshold queries.
+    The time-major output is read in whole blocks of rows that fit in
+    memory_mb. Blocks without data are NaN.
+    """
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        num_times, num_reaches = depth_variable.shape
+        rows_per_read = memory_mb * 1048576 // (8 * max(1, num_reaches))
+        rows_per_read = max(BLOCK_MAXIMA_SIZE, rows_per_read - rows_per_read % BLOCK_MAXIMA_SIZE)
+        num_blocks = -(-num_times // BLOCK_MAXIMA_SIZE)
+        block_maxima = np.empty((num_blocks, num_reaches), dtype=np.float32)
+        for time_start in range(0, num_times, rows_per_read):
+            values = np.ma.filled(np.ma.asarray(depth_variable[time_start:time_start + rows_per_read, :],
+                                                dtype=np.float64), np.nan)
+            values[~np.isfinite(values)] = np.nan
+            block_start = time_start // BLOCK_MAXIMA_SIZE
+            #fmax skips NaN unless the whole block is missing
+            block_maxima[block_start:block_start + -(-len(values) // BLOCK_MAXIMA_SIZE)] = \
+                np.fmax.reduceat(values, np.arange(0, len(values), BLOCK_MAXIMA_SIZE), axis=0)
+    finally:
+        data_nc.close()
+    return _save_sidecar_arrays(get_sidecar_path(prediction_file, BLOCK_MAXIMA_SUFFIX),
+                                prediction_file,
+                                block_maxima=block_maxima,
+                                block_size=np.array(BLOCK_MAXIMA_SIZE))
+
+def build_reach_array(prediction_file, memory_mb=DEFAULT_INGEST_MEMORY_MB):
+    """
+    Writes an uncompressed reach-major (reach, time) float32 .npy copy of
+    channelSurfacewaterDepth with NaN for missing values, and a JSON
+    header tying it to the source file. Requests read it through
+    numpy.memmap. The source is read in blocks of reaches that fit in
+    memory_mb.
+    """
+    array_file = get_sidecar_path(prediction_file, REACH_ARRAY_SUFFIX)
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        num_times, num_reaches = depth_variable.shape
+        reaches_per_block = max(1, memory_mb * 1048576 // (8 * max(1, num_times)))
+        temp_file = _get_temp_sidecar_path(array_file)
+        reach_array = np.lib.format.open_memmap(temp_file, mode='w+', dtype='<f4',
+                                                shape=(num_reaches, num_times))
+        try:
+            for reach_start in range(0, num_reaches, reaches_per_block):
+                reach_end = min(num_reaches, reach_start + reaches_per_block)
+                reach_array[reach_start:reach_end, :] = \
+                    np.ma.filled(np.ma.asarray(depth_variable[:, reach_start:reach_end],
+                                               dtype='<f4'), np.nan).T
+            reach_array.flush()
+            del reach_array
+        except:
+            del reach_array
+            os.remove(temp_file)
+            raise
+    finally:
+        data_nc.close()
+    os.rename(temp_file, array_file)
+
+    #the header is written last, so a current header means a complete array
+    header = get_source_attributes(prediction_file)
+    header.update({
+        'array_file' : os.path.basename(array_file),
+        'layout' : 'reach_major',
+        'dtype' : '<f4',
+        'shape' : [num_reaches, num_times],
+    })
+    header_file = get_sidecar_path(prediction_file, REACH_ARRAY_HEADER_SUFFIX)
+    temp_file = _get_temp_sidecar_path(header_file)
+    with open(temp_file, 'w') as sidecar:
+        json.dump(header, sidecar)
+    os.rename(temp_file, header_file)
+    return header_file
+
+def find_prediction_files(prediction_directory):
+    """
+    Returns all of the prediction files under the ADHydro prediction directory
+    (<watershed>/<subbasin>/RapidResult_*_CF.nc)
+    """
+    return sorted(glob(os.path.join(prediction_directory, '*', '*', 'RapidResult_*_CF.nc')))
+
+def find_segmented_runs(prediction_directory):
+    """
+    Returns all of the segmented run folders under the ADHydro prediction
+    directory (<watershed>/<subbasin>/<run>.segments)
+    """
+    return sorted(run_directory for run_directory in
+                  glob(os.path.join(prediction_directory, '*', '*', '*' + SEGMENTED_RUN_SUFFIX))
+                  if os.path.isdir(run_directory))
+
+def find_segment_files(run_directory):
+    """
+    Returns the segment files (e.g. display.nc outputs) of a segmented run
+    """
+    return sorted(glob(os.path.join(run_directory, '*.nc')))
+
+def get_reference_time_ms(data_nc):
+    """
+    Returns the reference date of the ADHydro output (a Julian date) in
+    epoch milliseconds
+    """
+    jul_date = float(data_nc.variables['referenceDate'][0])
+    return int(round((jul_date - UNIX_EPOCH_JULIAN_DATE) * 86400000))
+
+def get_output_time_range(data_nc):
+    """
+    Returns the time of the first and last output step of the file in
+    epoch milliseconds (rounded like the time axis of the hydrographs)
+    """
+    reference_ms = get_reference_time_ms(data_nc)
+    current_time = data_nc.variables['currentTime']
+    return (reference_ms + int(round(float(current_time[0]) * 1000)),
+            reference_ms + int(round(float(current_time[-1]) * 1000)))
+
+def build_segment_index(run_directory, open_dataset=NET.Dataset):
+    """
+    Returns the index of the time range of each segment of the run sorted
+    by time and whether it differs from the saved index. Entries of the
+    saved index are reused for segments that did not change, so only new
+    or rewritten segments are opened (with open_dataset).
+    """
+    index_file = os.path.join(run_directory, SEGMENT_INDEX_FILE)
+    saved_segments = {}
+    if os.path.exists(index_file):
+        try:
+            with open(index_file) as segment_index:
+                saved_segments = dict((segment['source_file'], segment) for segment in
+                                      json.load(segment_index)['segments'])
+        except (ValueError, KeyError, TypeError):
+            #rebuild an unreadable index
+            saved_segments = {}
+
+    segments = []
+    changed = False
+    for segment_file in find_segment_files(run_directory):
+        source_attributes = get_source_attributes(segment_file)
+        segment = saved_segments.get(source_attributes['source_file'])
+        if segment is None or any(segment.get(name) != value
+                                  for name, value in source_attributes.items()):
+            data_nc = open_dataset(segment_file, mode="r")
+            try:
+                num_times = len(data_nc.variables['currentTime'])
+                if num_times == 0:
+                    #nothing written yet
+                    continue
+                start_time, end_time = get_output_time_range(data_nc)
+            finally:
+                data_nc.close()
+            segment = dict(source_attributes, start_time=start_time, end_time=end_time,
+                           num_times=num_times)
+            changed = True
+        segments.append(segment)
+    segments.sort(key=lambda segment: (segment['start_time'], segment['source_file']))
+    changed = changed or len(segments) != len(saved_segments)
+    return {'segments' : segments}, changed
+
+def save_segment_index(run_directory, segment_index):
+    """
+    Atomically writes the segment index into the run folder
+    """
+    index_file = os.path.join(run_directory, SEGMENT_INDEX_FILE)
+    temp_file = "%s.tmp%s" % (index_file, os.getpid())
+    with open(temp_file, 'w') as index:
+        json.dump(segment_index, index)
+    os.rename(temp_file, index_file)
+    return index_file
+
+def ingest_segmented_run(run_directory, memory_mb=DEFAULT_INGEST_MEMORY_MB, force=False,
+                         raw_arrays=False):
+    """
+    Builds the sidecars of each segment of the run and updates the index
+    of their time ranges
+    """
+    built_files = []
+    for segment_file in find_segment_files(run_directory):
+        built_files.extend(ingest_prediction_file(segment_file, memory_mb, force, raw_arrays))
+    segment_index, changed = build_segment_index(run_directory)
+    if force or changed:
+        built_files.append(save_segment_index(run_directory, segment_index))
+    return built_files
+
+#sidecar suffix and the function that builds it
+SIDECAR_BUILDERS = (
+    (REACH_SIDECAR_SUFFIX, build_reach_sidecar),
+    (REACH_INDEX_SUFFIX, build_reach_index),
+    (REACH_STATS_SUFFIX, build_reach_stats),
+    (BLOCK_MAXIMA_SUFFIX, build_block_maxima),
+)
+#sidecars that are only built on request (they are not compressed)
+RAW_ARRAY_BUILDERS = (
+    (REACH_ARRAY_HEADER_SUFFIX, build_reach_array),
+)
+
+def ingest_prediction_file(prediction_file, memory_mb=DEFAULT_INGEST_MEMORY_MB, force=False,
+                           raw_arrays=False):
+    """
+    Builds the sidecars of one prediction file if they are missing or stale
+    """
+    built_files = []
+    #keep raw arrays that were built before up to date
+    raw_arrays = raw_arrays or os.path.exists(get_sidecar_path(prediction_file,
+                                                               REACH_ARRAY_HEADER_SUFFIX))
+    sidecar_builders = SIDECAR_BUILDERS + (RAW_ARRAY_BUILDERS if raw_arrays else ())
+    for suffix, build_sidecar in sidecar_builders:
+        sidecar_file = get_sidecar_path(prediction_file, suffix)
+        if force or not sidecar_is_current(sidecar_file, prediction_file):
+            built_files.append(build_sidecar(prediction_file, memory_mb))
+    return built_files
+
+def ingest_prediction_directory(prediction_directory, memory_mb=DEFAULT_INGEST_MEMORY_MB,
+                                force=False, raw_arrays=False):
+    """
+    Builds missing or stale sidecars for all prediction files and the
+    segments of segmented runs
+    """
+    for prediction_file in find_prediction_files(prediction_directory):
+        try:
+            for built_file in ingest_prediction_file(prediction_file, memory_mb, force,
+                                                     raw_arrays):
+                print("Built %s" % built_file)
+        except Exception as ex:
+            print("Skipping %s: %s" % (prediction_file, ex))
+    for run_directory in find_segmented_runs(prediction_directory):
+        try:
+            for built_file in ingest_segmented_run(run_directory, memory_mb, force, raw_arrays):
+                print("Built %s" % built_file)
+        except Exception as ex:
+            print("Skipping %s: %s" % (run_directory, ex))
+
+def update_forecast_catalog(prediction_directory, subbasin_directory=None):
+    """
+    Syncs the forecast catalog of the app with the prediction directory
+    (or only one of its subbasin folders). Returns the number of entries
+    added or updated and removed.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tethys_apps.settings")
+    from tethys_apps.tethysapp.adhydro_streamflow.forecast_catalog import (
+        rescan_forecast_catalog, update_subbasin_catalog)
+    if subbasin_directory is not None:
+        return update_subbasin_catalog(subbasin_directory)
+    return rescan_forecast_catalog(prediction_directory)
+
+def get_prediction_directory():
+    """
+    Gets the ADHydro prediction directory from the app settings
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tethys_apps.settings")
+    from tethys_apps.tethysapp.adhydro_streamflow.model import (MainSettings,
+                                                               SettingsSessionMaker)
+    session = SettingsSessionMaker()
+    main_settings = session.query(MainSettings).order_by(MainSettings.id).first()
+    session.close()
+    return main_settings.adhydro_prediction_directory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds sidecar files for ADHydro predictions.")
+    parser.add_argument('prediction_directory', nargs='?',
+                        help="ADHydro prediction directory (default: from app settings)")
+    parser.add_argument('--memory-mb', type=int, default=DEFAULT_INGEST_MEMORY_MB,
+                        help="Memory to use when transposing the output")
+    parser.add_argument('--force', action='store_true',
+                        help="Rebuild sidecars that are up to date")
+    parser.add_argument('--raw-arrays', action='store_true',
+                        help="Also write uncompressed arrays for memory-mapped reads")
+    parser.add_argument('--catalog-only', action='store_true',
+                        help="Only rescan the forecast catalog, do not build sidecars")
+    args = parser.parse_args()
+    prediction_directory = args.prediction_directory or get_prediction_directory()
+    if not args.catalog_only:
+        ingest_prediction_directory(prediction_directory, args.memory_mb, args.force,
+                                    args.raw_arrays)
+    try:
+        print("Forecast catalog: %s added or updated, %s removed" %
+              update_forecast_catalog(prediction_directory))
+    except ImportError as ex:
+        print("Forecast catalog not updated (run in the Tethys environment): %s" % ex)
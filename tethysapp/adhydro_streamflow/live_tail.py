@@ -0,0 +1,98 @@
+"""
+Live tail of hydrographs from runs that are still being written.
+
+The output of a running model grows along the time dimension. A tail
+remembers the last output step it served and only reads the records after
+it, and only when the file (or the segments of a segmented run) changed.
+New records are sent as server-sent events, whose ids are the last output
+step served so a reconnecting EventSource resumes where it stopped, or
+returned to long-poll requests.
+"""
+import json
+import numpy as np
+import time
+#local imports
+from .hydrograph import mask_missing
+
+#output steps are in whole milliseconds
+ONE_MILLISECOND = np.timedelta64(1, 'ms')
+
+
+def format_server_sent_event(event, data, event_id=None):
+    """
+    Returns the text/event-stream message of the event with JSON data
+    """
+    message = "event: %s\n" % event
+    if event_id is not None:
+        message += "id: %s\n" % event_id
+    return message + "data: %s\n\n" % json.dumps(data)
+
+def get_tail_delta(time_ms, data_values):
+    """
+    Returns the JSON fields of the records read after the last output step
+    """
+    return {
+        "time" : time_ms.tolist(),
+        "values" : mask_missing(data_values).tolist(),
+    }
+
+def read_new_records(read_records, get_version, last_time, version):
+    """
+    Reads the records after last_time if the version of the source
+    changed. Returns the times in milliseconds, the depths and the version
+    that was read. The version is not updated if the source could not be
+    read (e.g. while the model is writing to it), so it is read again.
+    """
+    try:
+        current_version = get_version()
+    except (IOError, OSError):
+        #the file is being replaced
+        return None, None, version
+    if current_version == version:
+        return None, None, version
+    start_time = None if last_time is None else last_time + ONE_MILLISECOND
+    try:
+        time_ms, data_values = read_records(start_time)
+    except Exception:
+        return None, None, version
+    return time_ms, data_values, current_version
+
+def iter_tail_events(read_records, get_version, last_time, poll_seconds, max_seconds):
+    """
+    Yields server-sent events with the records added to the source every
+    poll_seconds for max_seconds. The browser reconnects after the stream
+    ends and sends the id of the last event as Last-Event-ID.
+    """
+    stop_time = time.time() + max_seconds
+    version = None
+    yield "retry: %d\n\n" % int(poll_seconds * 1000)
+    while True:
+        time_ms, data_values, version = read_new_records(read_records, get_version,
+                                                         last_time, version)
+        if time_ms is not None and len(time_ms):
+            last_time = np.datetime64(int(time_ms[-1]), 'ms')
+            yield format_server_sent_event("delta", get_tail_delta(time_ms, data_values),
+                                           int(time_ms[-1]))
+        if time.time() + poll_seconds > stop_time:
+            break
+        #comment line that keeps proxies from closing an idle stream
+        yield ": waiting\n\n"
+        time.sleep(poll_seconds)
+    yield format_server_sent_event("end", {"reconnect" : True})
+
+def wait_for_records(read_records, get_version, last_time, poll_seconds, timeout_seconds):
+    """
+    Waits up to timeout_seconds for records after last_time (long-poll).
+    Returns the times in milliseconds and the depths, which are empty if
+    the source did not grow.
+    """
+    stop_time = time.time() + timeout_seconds
+    version = None
+    while True:
+        time_ms, data_values, version = read_new_records(read_records, get_version,
+                                                         last_time, version)
+        if time_ms is not None and len(time_ms):
+            return time_ms, data_values
+        if time.time() + poll_seconds > stop_time:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        time.sleep(poll_seconds)
@@ -1,6 +1,7 @@
 # Put your persistent store models in this file
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey
+from sqlalchemy import (BigInteger, Boolean, Column, Float, Index, Integer, String,
+                        ForeignKey)
 from sqlalchemy.orm import relationship, sessionmaker
 from uuid import uuid5, NAMESPACE_DNS
 from datetime import datetime
@@ -79,6 +80,40 @@ class DataStoreType(Base):
         self.code_name = code_name
         self.human_readable_name = human_readable_name
 
+class ForecastFile(Base):
+    '''
+    ForecastFile SQLAlchemy DB Model (catalog of the ADHydro prediction files)
+    '''
+    __tablename__ = 'forecast_file'
+    #the forecasts of a subbasin are listed newest first
+    __table_args__ = (Index('ix_forecast_file_subbasin_date', 'watershed_name',
+                            'subbasin_name', 'date_string'),)
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    watershed_name = Column(String)
+    subbasin_name = Column(String)
+    date_string = Column(String)
+    path = Column(String, unique=True)
+    size = Column(BigInteger)
+    mtime = Column(Float)
+    #first and last output step in epoch milliseconds
+    start_time = Column(BigInteger)
+    end_time = Column(BigInteger)
+    reach_count = Column(Integer)
+
+    def __init__(self, watershed_name, subbasin_name, date_string, path, size, mtime,
+                 start_time, end_time, reach_count):
+        self.watershed_name = watershed_name
+        self.subbasin_name = subbasin_name
+        self.date_string = date_string
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.start_time = start_time
+        self.end_time = end_time
+        self.reach_count = reach_count
+
 class Geoserver(Base):
     '''
     Geoserver SQLAlchemy DB Model
@@ -42,6 +42,7 @@ var ERFP_MAP = (function() {
         m_short_term_chart_data_ajax_load_failed,
         m_short_term_select_data_ajax_handle,
         m_adhydro_date_string,
+        m_hydrograph_max_points,
         m_units;
 
 
@@ -526,6 +527,7 @@ var ERFP_MAP = (function() {
                         subbasin_name: m_selected_adhydro_subbasin,
                         reach_id: m_selected_reach_id,
                         date_string: m_adhydro_date_string,
+                        max_points: m_hydrograph_max_points,
                     },
                     success: function (data) {
                         if ("success" in data) {
@@ -550,6 +552,10 @@ var ERFP_MAP = (function() {
                     },
                     error: function (request, status, error) {
                         m_short_term_chart_data_ajax_load_failed = true;
+                        //use the server message if there is one (e.g. unknown reach)
+                        if (request.responseJSON && "error" in request.responseJSON) {
+                            error = request.responseJSON.error;
+                        }
                         appendErrorMessage("Error: " + error, "adhydro_error", "message-error");
                         clearChartSelect2('short-term');
                     },
@@ -893,6 +899,8 @@ var ERFP_MAP = (function() {
         m_short_term_chart_data_ajax_load_failed = false;
         m_long_term_select_data_ajax_handle = null;
         m_adhydro_date_string = "most_recent";
+        //limit points sent to the chart (server downsamples longer runs)
+        m_hydrograph_max_points = 4000;
         //Init from toggle
         m_units = "metric";
         if(!$('#units-toggle').bootstrapSwitch('state')) {
@@ -0,0 +1,51 @@
+import json
+import numpy as np
+import os
+#local imports
+from .dataset_pool import FingerprintCache, get_file_fingerprint
+from .ingest import (get_sidecar_path, sidecar_is_current, REACH_ARRAY_HEADER_SUFFIX,
+                     REACH_ARRAY_SUFFIX)
+
+#memory maps kept open between requests
+REACH_ARRAY_CACHE_SIZE = 16
+
+_reach_array_cache = FingerprintCache(REACH_ARRAY_CACHE_SIZE)
+
+
+def load_reach_array(prediction_file):
+    """
+    Returns the raw reach-major array of the prediction file as a
+    read-only numpy.memmap or None if it was not built or is stale.
+    Pages of the array are shared by all processes through the OS page
+    cache. Memory maps are cached per version of the file.
+    """
+    fingerprint = get_file_fingerprint(prediction_file)
+    reach_array = _reach_array_cache.get(fingerprint)
+    if reach_array is not None:
+        return reach_array
+
+    header_file = get_sidecar_path(prediction_file, REACH_ARRAY_HEADER_SUFFIX)
+    if not sidecar_is_current(header_file, prediction_file):
+        return None
+    with open(header_file) as header:
+        header = json.load(header)
+    array_file = get_sidecar_path(prediction_file, REACH_ARRAY_SUFFIX)
+    if header.get('layout') != 'reach_major' or not os.path.exists(array_file):
+        return None
+    reach_array = np.load(array_file, mmap_mode='r')
+    if list(reach_array.shape) != header['shape']:
+        return None
+
+    return _reach_array_cache.set(fingerprint, reach_array)
+
+def read_reach_array_depths(reach_array, reach_indices, time_slice=slice(None)):
+    """
+    Reads the depths of the reaches from the raw reach-major array.
+    Returns a contiguous float32 (time, reach) array with NaN for missing
+    values and the columns in the order of reach_indices.
+    """
+    if len(reach_indices) == 1:
+        #a view of one contiguous slice of the memory map (no copy)
+        return np.asarray(reach_array[int(reach_indices[0]), time_slice])[:, np.newaxis]
+    return np.ascontiguousarray(reach_array[np.asarray(reach_indices, dtype=np.int64),
+                                            time_slice].T)
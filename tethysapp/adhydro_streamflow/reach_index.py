@@ -0,0 +1,75 @@
+import numpy as np
+#local imports
+from .dataset_pool import FingerprintCache, get_file_fingerprint, pooled_dataset
+from .ingest import (get_reach_ids, get_sidecar_path, sidecar_is_current,
+                     REACH_INDEX_SUFFIX)
+
+REACH_INDEX_CACHE_SIZE = 64
+
+_reach_index_cache = FingerprintCache(REACH_INDEX_CACHE_SIZE)
+
+
+class ReachIndex(object):
+    """
+    Sorted reach id (COMID) to array position lookup for a forecast file
+    """
+    def __init__(self, sorted_reach_ids, reach_indices):
+        self.sorted_reach_ids = sorted_reach_ids
+        self.reach_indices = reach_indices
+
+    @classmethod
+    def from_reach_ids(cls, reach_ids):
+        reach_indices = np.argsort(reach_ids, kind='mergesort')
+        return cls(reach_ids[reach_indices], reach_indices)
+
+    def get_reach_ids(self):
+        """
+        Returns the reach ids in the order of the reaches in the file
+        """
+        reach_ids = np.empty_like(self.sorted_reach_ids)
+        reach_ids[self.reach_indices] = self.sorted_reach_ids
+        return reach_ids
+
+    def get_index(self, reach_id):
+        """
+        Returns the position of the reach in the file or None if unknown
+        """
+        try:
+            reach_id = int(reach_id)
+        except (TypeError, ValueError):
+            return None
+        position = int(np.searchsorted(self.sorted_reach_ids, reach_id))
+        if position < len(self.sorted_reach_ids) and \
+            self.sorted_reach_ids[position] == reach_id:
+            return int(self.reach_indices[position])
+        return None
+
+
+def read_reach_index(prediction_file):
+    """
+    Reads the reach index from the sidecar or, if it is missing, from the
+    pooled dataset, without the cache
+    """
+    sidecar_file = get_sidecar_path(prediction_file, REACH_INDEX_SUFFIX)
+    if sidecar_is_current(sidecar_file, prediction_file):
+        sidecar_arrays = np.load(sidecar_file)
+        try:
+            return ReachIndex(sidecar_arrays['reach_ids'], sidecar_arrays['reach_indices'])
+        finally:
+            sidecar_arrays.close()
+    with pooled_dataset(prediction_file) as data_nc:
+        return ReachIndex.from_reach_ids(get_reach_ids(data_nc))
+
+def load_reach_index(prediction_file):
+    """
+    Returns the reach index of the prediction file. It is read from the
+    sidecar built at ingest or, if missing, from the ids in the file.
+    Indexes are cached per version of the file.
+    """
+    fingerprint = get_file_fingerprint(prediction_file)
+    reach_index = _reach_index_cache.get(fingerprint)
+    if reach_index is not None:
+        return reach_index
+
+    reach_index = read_reach_index(prediction_file)
+    return _reach_index_cache.set(fingerprint, reach_index)
@@ -0,0 +1,47 @@
+import numpy as np
+#local imports
+from .dataset_pool import FingerprintCache, get_file_fingerprint
+from .ingest import get_sidecar_path, sidecar_is_current, REACH_STATS_SUFFIX
+
+REACH_STATS_CACHE_SIZE = 16
+#per-reach statistics the reaches can be ranked by
+REACH_STATS_FIELDS = ('maximum', 'minimum', 'mean')
+
+_reach_stats_cache = FingerprintCache(REACH_STATS_CACHE_SIZE)
+
+
+def load_reach_stats(prediction_file):
+    """
+    Returns the per-reach statistics arrays built at ingest or None if the
+    sidecar is missing or stale. Statistics are cached per version of
+    the file.
+    """
+    fingerprint = get_file_fingerprint(prediction_file)
+    reach_stats = _reach_stats_cache.get(fingerprint)
+    if reach_stats is not None:
+        return reach_stats
+
+    sidecar_file = get_sidecar_path(prediction_file, REACH_STATS_SUFFIX)
+    if not sidecar_is_current(sidecar_file, prediction_file):
+        return None
+    sidecar_arrays = np.load(sidecar_file)
+    try:
+        reach_stats = dict((name, sidecar_arrays[name]) for name in
+                           REACH_STATS_FIELDS + ('peak_time_index', 'percentile_levels',
+                                                 'percentiles'))
+    finally:
+        sidecar_arrays.close()
+
+    return _reach_stats_cache.set(fingerprint, reach_stats)
+
+def rank_reaches(values, limit):
+    """
+    Returns the positions of the reaches with the largest values in
+    descending order. Reaches without data come last.
+    """
+    values = np.where(np.isnan(values), -np.inf, values)
+    limit = min(limit, len(values))
+    if limit <= 0:
+        return np.array([], dtype=np.int64)
+    top_positions = np.argpartition(-values, limit - 1)[:limit]
+    return top_positions[np.argsort(-values[top_positions], kind='mergesort')]
@@ -0,0 +1,204 @@
+"""
+Reader backends for hydrograph reads.
+
+Every backend returns a contiguous float32 (time, reach) ndarray with NaN
+for missing values (no masked arrays). The backend is selected with the
+READER_BACKEND setting:
+
+- netcdf4: netCDF4 reads of the reach-major sidecar or the forecast file
+- h5py: h5py reads of the same files without the netCDF4 layer
+- memmap: numpy.memmap reads of the raw array built with
+  "ingest.py --raw-arrays" (netcdf4 for files without one)
+"""
+import netCDF4 as NET
+import numpy as np
+import os
+try:
+    import h5py
+except ImportError:
+    h5py = None
+#local imports
+from .chunk_cache import DEFAULT_CHUNK_CACHE_MB
+from .dataset_pool import pooled_dataset, register_dataset_pool, DatasetPool, HDF5_LOCK
+from .hydrograph import get_time_slice, load_time_axis
+from .ingest import (get_sidecar_path, get_source_attributes, sidecar_matches_source,
+                     REACH_SIDECAR_SUFFIX)
+from .reach_array import load_reach_array, read_reach_array_depths
+from .utilities import get_app_setting
+
+DEFAULT_READER_BACKEND = 'memmap'
+#largest read of the columns between the requested reaches
+MAX_SPAN_READ_BYTES = 67108864
+#hash slots of the h5py chunk cache (a prime)
+H5PY_CHUNK_CACHE_SLOTS = 10007
+
+
+def nan_filled(data_values, fill_values):
+    """
+    Returns the raw values as contiguous float32 with NaN for fill values
+    """
+    data_values = np.array(data_values, dtype=np.float32, order='C')
+    for fill_value in fill_values:
+        if fill_value is not None:
+            data_values[data_values == np.float32(fill_value)] = np.nan
+    return data_values
+
+def _empty_depths(reach_indices):
+    return np.empty((0, len(reach_indices)), dtype=np.float32)
+
+
+class NetCDF4Reader(object):
+    """
+    Reads with netCDF4 from the reach-major sidecar if it is up to date,
+    otherwise from the time-major forecast file
+    """
+    name = 'netcdf4'
+
+    def read_depths(self, forecast_file, reach_indices, time_slice):
+        if time_slice.stop <= time_slice.start:
+            return _empty_depths(reach_indices)
+        #netCDF4 needs sorted, unique indices for fancy indexing
+        unique_indices, column_positions = np.unique(reach_indices, return_inverse=True)
+        sidecar_file = get_sidecar_path(forecast_file, REACH_SIDECAR_SUFFIX)
+        if os.path.exists(sidecar_file):
+            with pooled_dataset(sidecar_file) as sidecar_nc:
+                if sidecar_matches_source(sidecar_nc, forecast_file):
+                    data_values, fill_values = self._read(sidecar_nc, unique_indices,
+                                                          time_slice, True)
+                    return nan_filled(data_values[:, column_positions], fill_values)
+        with pooled_dataset(forecast_file) as data_nc:
+            data_values, fill_values = self._read(data_nc, unique_indices, time_slice, False)
+        return nan_filled(data_values[:, column_positions], fill_values)
+
+    def _read(self, data_nc, unique_indices, time_slice, reach_major):
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        first_index, last_index = int(unique_indices[0]), int(unique_indices[-1])
+        span_bytes = (last_index - first_index + 1) * depth_variable.dtype.itemsize * \
+            (time_slice.stop - time_slice.start)
+        #netCDF4 reads each listed column of a time-major variable on its
+        #own, one read of the columns in between is much faster
+        span_read = not reach_major and len(unique_indices) > 1 and \
+            span_bytes <= MAX_SPAN_READ_BYTES
+        #pooled handles are shared, so no other thread may read while the mask is off
+        with HDF5_LOCK:
+            #skip building a mask, fill values become NaN instead
+            depth_variable.set_auto_mask(False)
+            try:
+                if reach_major:
+                    data_values = depth_variable[unique_indices.tolist(), time_slice].T
+                elif span_read:
+                    data_values = depth_variable[time_slice, first_index:last_index + 1]
+                else:
+                    data_values = depth_variable[time_slice, unique_indices.tolist()]
+            finally:
+                depth_variable.set_auto_mask(True)
+        if span_read:
+            data_values = data_values[:, unique_indices - first_index]
+        fill_values = (getattr(depth_variable, '_FillValue',
+                               NET.default_fillvals.get(depth_variable.dtype.str[1:])),
+                       getattr(depth_variable, 'missing_value', None))
+        return data_values, fill_values
+
+
+def _open_h5py_file(path):
+    #h5py sets the chunk cache per file when it is opened
+    return h5py.File(path, 'r', rdcc_nbytes=int(get_app_setting('CHUNK_CACHE_MB',
+                                                                DEFAULT_CHUNK_CACHE_MB) * 1048576),
+                     rdcc_nslots=H5PY_CHUNK_CACHE_SLOTS)
+
+def _h5py_sidecar_matches_source(sidecar_h5, prediction_file):
+    for name, value in get_source_attributes(prediction_file).items():
+        attribute = sidecar_h5.attrs.get(name)
+        if isinstance(attribute, bytes) and not isinstance(value, bytes):
+            attribute = attribute.decode('utf-8')
+        if attribute is None or attribute != value:
+            return False
+    return True
+
+
+class H5pyReader(object):
+    """
+    Reads the netCDF-4 (HDF5) files directly with h5py from the
+    reach-major sidecar if it is up to date, otherwise from the forecast
+    file. h5py handles are kept in their own pool.
+    """
+    name = 'h5py'
+
+    def __init__(self):
+        self.pool = register_dataset_pool(DatasetPool(get_app_setting('MAX_OPEN_DATASETS', 16),
+                                                      open_dataset=_open_h5py_file))
+
+    def read_depths(self, forecast_file, reach_indices, time_slice):
+        if time_slice.stop <= time_slice.start:
+            return _empty_depths(reach_indices)
+        #h5py needs increasing indices for fancy indexing
+        unique_indices, column_positions = np.unique(reach_indices, return_inverse=True)
+        sidecar_file = get_sidecar_path(forecast_file, REACH_SIDECAR_SUFFIX)
+        if os.path.exists(sidecar_file):
+            with self.pool.dataset(sidecar_file) as sidecar_h5:
+                if _h5py_sidecar_matches_source(sidecar_h5, forecast_file):
+                    depth_dataset = sidecar_h5['channelSurfacewaterDepth']
+                    data_values = depth_dataset[unique_indices.tolist(), time_slice].T
+                    return nan_filled(data_values[:, column_positions],
+                                      self._get_fill_values(depth_dataset))
+        with self.pool.dataset(forecast_file) as data_h5:
+            depth_dataset = data_h5['channelSurfacewaterDepth']
+            data_values = depth_dataset[time_slice, unique_indices.tolist()]
+            return nan_filled(data_values[:, column_positions],
+                              self._get_fill_values(depth_dataset))
+
+    def _get_fill_values(self, depth_dataset):
+        fill_value = depth_dataset.attrs.get('_FillValue')
+        fill_value = depth_dataset.fillvalue if fill_value is None else np.ravel(fill_value)[0]
+        missing_value = depth_dataset.attrs.get('missing_value')
+        return (fill_value, None if missing_value is None else np.ravel(missing_value)[0])
+
+
+class MemmapReader(object):
+    """
+    Reads the raw reach-major array through numpy.memmap. Files without
+    an up to date raw array are read with the fallback reader.
+    """
+    name = 'memmap'
+
+    def __init__(self, fallback_reader):
+        self.fallback_reader = fallback_reader
+
+    def read_depths(self, forecast_file, reach_indices, time_slice):
+        reach_array = load_reach_array(forecast_file)
+        if reach_array is None:
+            return self.fallback_reader.read_depths(forecast_file, reach_indices, time_slice)
+        return read_reach_array_depths(reach_array, reach_indices, time_slice)
+
+
+_netcdf4_reader = NetCDF4Reader()
+READERS = {
+    'netcdf4' : _netcdf4_reader,
+    'memmap' : MemmapReader(_netcdf4_reader),
+}
+if h5py is not None:
+    READERS['h5py'] = H5pyReader()
+
+
+def get_reader(name=None):
+    """
+    Returns the reader backend with the name (default: READER_BACKEND
+    setting). Falls back to netcdf4 if the backend is not available
+    (e.g. h5py is not installed).
+    """
+    name = name or get_app_setting('READER_BACKEND', DEFAULT_READER_BACKEND)
+    return READERS.get(name, _netcdf4_reader)
+
+def read_forecast_depths(forecast_file, reach_indices, start_time=None, end_time=None,
+                         reader=None):
+    """
+    Reads the depths of the reaches in the time window with the reader
+    backend. Returns the times in milliseconds and a contiguous float32
+    (time, reach) array with NaN for missing values.
+    """
+    time_axis = load_time_axis(forecast_file)
+    #only read the requested time window
+    time_slice = get_time_slice(time_axis, start_time, end_time)
+    data_values = (reader or get_reader()).read_depths(forecast_file, reach_indices,
+                                                       time_slice)
+    return time_axis[time_slice].astype(np.int64), data_values
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Rewrites prediction files with chunks tuned for reach-wise reads.
+
+channelSurfacewaterDepth is rewritten with chunks that span the whole time
+axis of as many reaches as fit in RECHUNK_CHUNK_BYTES, so the hydrograph
+of a reach is read from one chunk, and compressed with zlib and shuffle.
+Reading all reaches at one time step touches every chunk of the file, so
+it gets slower. Files that already have that layout are skipped. The size
+and the time to read a few time steps and hydrographs are reported before
+and after.
+"""
+import argparse
+from multiprocessing import Pool
+import netCDF4 as NET
+import numpy as np
+import os
+import time
+#local imports
+from convert_output import copy_variable, VIEWER_COMPLEVEL
+from ingest import find_prediction_files, ingest_prediction_file, DEFAULT_INGEST_MEMORY_MB
+
+#largest chunk of the rewritten files (the default HDF5 chunk cache holds one)
+RECHUNK_CHUNK_BYTES = 1048576
+#time steps and hydrographs read to measure the read latency
+LATENCY_SAMPLES = 5
+
+
+def get_rechunk_chunks(num_times, num_reaches, item_size):
+    """
+    Returns the (time, reach) chunk sizes for reach-wise reads. Chunks
+    span the whole time axis of a block of reaches, the time axis is only
+    split if one reach does not fit in RECHUNK_CHUNK_BYTES.
+    """
+    time_chunk = max(1, min(num_times, RECHUNK_CHUNK_BYTES // item_size))
+    reach_chunk = max(1, min(num_reaches, RECHUNK_CHUNK_BYTES // (item_size * time_chunk)))
+    return time_chunk, reach_chunk
+
+def is_optimized(prediction_file):
+    """
+    Checks if channelSurfacewaterDepth already has the reach-wise chunks
+    and compression
+    """
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        num_times, num_reaches = depth_variable.shape
+        chunks = get_rechunk_chunks(num_times, num_reaches, depth_variable.dtype.itemsize)
+        filters = depth_variable.filters() or {}
+        return depth_variable.chunking() == list(chunks) and \
+            bool(filters.get('zlib')) and bool(filters.get('shuffle'))
+    finally:
+        data_nc.close()
+
+def measure_read_latency(prediction_file):
+    """
+    Returns the average time in milliseconds to read all reaches at a time
+    step and to read the whole hydrograph of a reach, sampled over the file
+    """
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        depth_variable = data_nc.variables['channelSurfacewaterDepth']
+        num_times, num_reaches = depth_variable.shape
+        time_indices = np.linspace(0, num_times - 1, LATENCY_SAMPLES).astype(np.int64)
+        reach_indices = np.linspace(0, num_reaches - 1, LATENCY_SAMPLES).astype(np.int64)
+        start = time.time()
+        for time_index in time_indices:
+            depth_variable[time_index, :]
+        row_latency = (time.time() - start) * 1000.0 / len(time_indices)
+        start = time.time()
+        for reach_index in reach_indices:
+            depth_variable[:, reach_index]
+        return row_latency, (time.time() - start) * 1000.0 / len(reach_indices)
+    finally:
+        data_nc.close()
+
+def rechunk_prediction_file(prediction_file, memory_mb=DEFAULT_INGEST_MEMORY_MB,
+                            build_sidecars=True):
+    """
+    Rewrites the prediction file with reach-wise chunks. The depths are
+    copied in whole tiles of chunks that fit in memory_mb and the file is
+    replaced atomically.
+    """
+    temp_file = "%s.tmp%s" % (prediction_file, os.getpid())
+    data_nc = NET.Dataset(prediction_file, mode="r")
+    try:
+        rechunked_nc = NET.Dataset(temp_file, mode="w", format="NETCDF4")
+        try:
+            rechunked_nc.setncatts(dict((name, data_nc.getncattr(name))
+                                        for name in data_nc.ncattrs()))
+            for variable_name in data_nc.variables:
+                if variable_name == 'channelSurfacewaterDepth':
+                    continue
+                source_variable, rechunked_variable = copy_variable(data_nc, rechunked_nc,
+                                                                    variable_name)
+                rechunked_variable[:] = source_variable[:]
+
+            depth_variable = data_nc.variables['channelSurfacewaterDepth']
+            num_times, num_reaches = depth_variable.shape
+            item_size = depth_variable.dtype.itemsize
+            time_chunk, reach_chunk = get_rechunk_chunks(num_times, num_reaches, item_size)
+            source_variable, rechunked_variable = copy_variable(data_nc, rechunked_nc,
+                                                                'channelSurfacewaterDepth',
+                                                                zlib=True, shuffle=True,
+                                                                complevel=VIEWER_COMPLEVEL,
+                                                                chunksizes=(time_chunk,
+                                                                            reach_chunk))
+            #whole chunks of reaches over all times if they fit, else whole tiles
+            memory_bytes = memory_mb * 1048576
+            reaches_per_block = memory_bytes // (item_size * num_times)
+            reaches_per_block = max(reach_chunk,
+                                    reaches_per_block - reaches_per_block % reach_chunk)
+            times_per_block = memory_bytes // (item_size * reaches_per_block)
+            times_per_block = min(num_times,
+                                  max(time_chunk, times_per_block - times_per_block % time_chunk))
+            for reach_start in range(0, num_reaches, reaches_per_block):
+                reach_end = min(num_reaches, reach_start + reaches_per_block)
+                for time_start in range(0, num_times, times_per_block):
+                    time_end = min(num_times, time_start + times_per_block)
+                    rechunked_variable[time_start:time_end, reach_start:reach_end] = \
+                        source_variable[time_start:time_end, reach_start:reach_end]
+            rechunked_nc.close()
+        except:
+            rechunked_nc.close()
+            os.remove(temp_file)
+            raise
+    finally:
+        data_nc.close()
+    os.rename(temp_file, prediction_file)
+
+    #the sidecars of the old version are stale
+    if build_sidecars:
+        ingest_prediction_file(prediction_file, memory_mb)
+    return prediction_file
+
+def transcode_prediction_file(arguments):
+    """
+    Rechunks one prediction file unless it is already optimized.
+    Returns a report line.
+    """
+    prediction_file, memory_mb, force = arguments
+    try:
+        if not force and is_optimized(prediction_file):
+            return "Skipped %s (already optimized)" % prediction_file
+        size_before = os.path.getsize(prediction_file)
+        latency_before = measure_read_latency(prediction_file)
+        rechunk_prediction_file(prediction_file, memory_mb)
+        size_after = os.path.getsize(prediction_file)
+        latency_after = measure_read_latency(prediction_file)
+    except Exception as ex:
+        return "Failed %s: %s" % (prediction_file, ex)
+    return "Rechunked %s: size %.1f MB -> %.1f MB, time step read %.1f ms -> %.1f ms, " \
+        "hydrograph read %.1f ms -> %.1f ms" % \
+        (prediction_file, size_before / 1048576.0, size_after / 1048576.0,
+         latency_before[0], latency_after[0], latency_before[1], latency_after[1])
+
+def transcode_prediction_directory(prediction_directory, processes=None,
+                                   memory_mb=DEFAULT_INGEST_MEMORY_MB, force=False):
+    """
+    Rechunks all prediction files in a pool of processes
+    """
+    pool = Pool(processes)
+    try:
+        for report in pool.imap_unordered(transcode_prediction_file,
+                                          [(prediction_file, memory_mb, force) for prediction_file
+                                           in find_prediction_files(prediction_directory)]):
+            print(report)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rechunks ADHydro prediction files "
+                                                 "with chunks tuned for reach-wise reads.")
+    parser.add_argument('prediction_directory', help="ADHydro prediction directory")
+    parser.add_argument('--processes', type=int,
+                        help="Files to rechunk at the same time (default: number of CPUs)")
+    parser.add_argument('--memory-mb', type=int, default=DEFAULT_INGEST_MEMORY_MB,
+                        help="Memory each process uses when copying the output")
+    parser.add_argument('--force', action='store_true',
+                        help="Rechunk files that are already optimized")
+    args = parser.parse_args()
+    transcode_prediction_directory(args.prediction_directory, args.processes,
+                                   args.memory_mb, args.force)
@@ -0,0 +1,125 @@
+"""
+Virtual time series across the segments of a long ADHydro run.
+
+A segmented run is a <run>.segments folder in the subbasin folder holding
+the successive display.nc segments written by the model. The time range of
+each segment is kept in segment_index.json (see ingest.py), so a request
+only reads the segments that overlap its time window, in the comparison
+pool, and stitches them into one series.
+"""
+import numpy as np
+import os
+#local imports
+from .dataset_pool import FingerprintCache, get_file_fingerprint, open_locked_dataset
+from .forecast_comparison import read_forecast_hydrographs
+from .ingest import (build_segment_index, find_segment_files, save_segment_index,
+                     SEGMENTED_RUN_SUFFIX)
+
+SEGMENT_INDEX_CACHE_SIZE = 16
+
+_segment_index_cache = FingerprintCache(SEGMENT_INDEX_CACHE_SIZE)
+
+
+class SegmentIndex(object):
+    """
+    Segment files of a run sorted by time with the time of their first
+    and last output step
+    """
+    def __init__(self, segment_files, start_times, end_times):
+        self.segment_files = segment_files
+        self.start_times = start_times
+        self.end_times = end_times
+
+    @classmethod
+    def from_segments(cls, run_directory, segments):
+        return cls([os.path.join(run_directory, segment['source_file']) for segment in segments],
+                   np.array([segment['start_time'] for segment in segments], dtype='datetime64[ms]'),
+                   np.array([segment['end_time'] for segment in segments], dtype='datetime64[ms]'))
+
+    def get_segment_files(self, start_time=None, end_time=None):
+        """
+        Returns the segment files that overlap the time window (inclusive)
+        """
+        overlapping = np.ones(len(self.segment_files), dtype=bool)
+        if start_time is not None:
+            overlapping &= self.end_times >= start_time
+        if end_time is not None:
+            overlapping &= self.start_times <= end_time
+        return [self.segment_files[position] for position in np.flatnonzero(overlapping)]
+
+
+def get_segmented_run_directory(path_to_output_files, run_name):
+    """
+    Returns the folder of the segmented run in the subbasin folder or None
+    if there is no such run
+    """
+    run_directory = os.path.join(path_to_output_files, run_name + SEGMENTED_RUN_SUFFIX)
+    return run_directory if os.path.isdir(run_directory) else None
+
+def get_segment_files_version(run_directory):
+    """
+    Returns the fingerprints of the segment files of the run, which change
+    when a segment is added, removed or grows
+    """
+    return tuple(get_file_fingerprint(segment_file)
+                 for segment_file in find_segment_files(run_directory))
+
+def load_segment_index(run_directory):
+    """
+    Returns the segment index of the run. Indexes are cached per version
+    of the segment files, segments added or rewritten since the saved
+    index are indexed and the index is saved again if the folder is
+    writable.
+    """
+    fingerprint = get_segment_files_version(run_directory)
+    segment_index = _segment_index_cache.get(fingerprint)
+    if segment_index is not None:
+        return segment_index
+
+    segments, changed = build_segment_index(run_directory, open_locked_dataset)
+    if changed:
+        try:
+            save_segment_index(run_directory, segments)
+        except (IOError, OSError):
+            #the index is rebuilt in memory by the next server process
+            pass
+    segment_index = SegmentIndex.from_segments(run_directory, segments['segments'])
+
+    return _segment_index_cache.set(fingerprint, segment_index)
+
+def stitch_segments(hydrographs):
+    """
+    Joins the hydrographs of successive segments into one series. Output
+    steps that a segment repeats from the one before it (e.g. the restart
+    step) are dropped. Segments that were not read (None) are skipped.
+    """
+    time_axes = []
+    value_arrays = []
+    last_time = None
+    for hydrograph in hydrographs:
+        if hydrograph is None:
+            continue
+        time_ms, data_values = hydrograph
+        if last_time is not None:
+            kept = time_ms > last_time
+            time_ms, data_values = time_ms[kept], data_values[kept]
+        if len(time_ms):
+            time_axes.append(time_ms)
+            value_arrays.append(data_values)
+            last_time = time_ms[-1]
+    if not time_axes:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+    return np.concatenate(time_axes), np.concatenate(value_arrays)
+
+def read_segmented_hydrograph(segment_files, reach_id, start_time=None, end_time=None):
+    """
+    Reads the hydrograph of the reach in the time window from the
+    segments concurrently and stitches them. Returns the times in
+    milliseconds, the depths and the segment files that could not be read
+    or do not have the reach.
+    """
+    hydrographs = read_forecast_hydrographs(segment_files, reach_id, start_time, end_time)
+    missing_files = [segment_file for segment_file, hydrograph in zip(segment_files, hydrographs)
+                     if hydrograph is None]
+    time_ms, data_values = stitch_segments(hydrographs)
+    return time_ms, data_values, missing_files
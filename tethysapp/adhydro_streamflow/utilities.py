@@ -10,4 +10,17 @@ def get_persistent_store_engine(persistent_store_name):
     app_name = os.path.split(os.path.dirname(__file__))[1]
 
     # Get engine
-    return gpse(app_name, persistent_store_name)
\ No newline at end of file
+    return gpse(app_name, persistent_store_name)
+
+
+def get_app_setting(setting_name, default=None):
+    """
+    Returns the ADHYDRO_STREAMFLOW_<setting_name> value from the Django
+    settings or the default if it is not set.
+    """
+    try:
+        from django.conf import settings
+        return getattr(settings, 'ADHYDRO_STREAMFLOW_%s' % setting_name, default)
+    except Exception:
+        #settings not configured (e.g. running from the command line)
+        return default
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Watches the ADHydro prediction directory and ingests dropped files.
+
+New or replaced RapidResult_*_CF.nc files (and segments of segmented
+runs) are handled once their size and modification time stop changing:
+the variables the app needs are checked, the sidecars are built, the file
+is added to the forecast catalog (or the segment index of its run) and
+its small sidecars are read into the OS page cache, so the first request
+after a drop does not pay for any of it. Uses inotify through pyinotify
+when it is installed and polls the directory otherwise.
+"""
+import argparse
+from fnmatch import fnmatch
+import netCDF4 as NET
+import os
+import time
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+#local imports
+from convert_output import VIEWER_VARIABLES
+from ingest import (build_segment_index, find_prediction_files, find_segment_files,
+                    find_segmented_runs, get_prediction_directory, get_sidecar_path,
+                    ingest_prediction_file, save_segment_index, sidecar_is_current,
+                    update_forecast_catalog, BLOCK_MAXIMA_SUFFIX, DEFAULT_INGEST_MEMORY_MB,
+                    REACH_ARRAY_HEADER_SUFFIX, REACH_INDEX_SUFFIX, REACH_STATS_SUFFIX,
+                    SEGMENTED_RUN_SUFFIX)
+
+#seconds a file must stay unchanged before it is ingested
+DEFAULT_SETTLE_SECONDS = 10
+DEFAULT_POLL_SECONDS = 30
+#sidecars read into the page cache after ingest (the large ones are read on demand)
+WARM_SIDECAR_SUFFIXES = (REACH_INDEX_SUFFIX, REACH_STATS_SUFFIX, BLOCK_MAXIMA_SUFFIX,
+                         REACH_ARRAY_HEADER_SUFFIX)
+
+
+def get_file_signature(path):
+    """
+    Returns the (size, mtime) of the file or None if it is gone
+    """
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return file_stat.st_size, file_stat.st_mtime
+
+def validate_prediction_file(prediction_file):
+    """
+    Returns why the app cannot show the file or None if it is valid
+    """
+    try:
+        data_nc = NET.Dataset(prediction_file, mode="r")
+    except (IOError, RuntimeError) as ex:
+        return "cannot be opened (%s)" % ex
+    try:
+        missing_variables = [name for name in VIEWER_VARIABLES if name not in data_nc.variables]
+        if missing_variables:
+            return "is missing %s" % ", ".join(missing_variables)
+        depth_shape = data_nc.variables['channelSurfacewaterDepth'].shape
+        if len(depth_shape) != 2 or depth_shape[0] != len(data_nc.variables['currentTime']):
+            return "channelSurfacewaterDepth is not (time, channel element)"
+        if depth_shape[0] == 0:
+            return "has no output steps"
+    finally:
+        data_nc.close()
+    return None
+
+def warm_page_cache(paths, block_size=1048576):
+    """
+    Reads the files so that the server finds them in the OS page cache
+    """
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as warm_file:
+                while warm_file.read(block_size):
+                    pass
+
+
+class PredictionWatcher(object):
+    """
+    Keeps track of the prediction files and ingests the ones that are new
+    or changed once they stop changing
+    """
+    def __init__(self, prediction_directory, settle_seconds=DEFAULT_SETTLE_SECONDS,
+                 memory_mb=DEFAULT_INGEST_MEMORY_MB, raw_arrays=False):
+        self.prediction_directory = os.path.abspath(prediction_directory)
+        self.settle_seconds = settle_seconds
+        self.memory_mb = memory_mb
+        self.raw_arrays = raw_arrays
+        self.update_catalog = True
+        #path: (size, mtime) when it was last handled
+        self.handled_files = {}
+        #path: ((size, mtime), time it was first seen with them)
+        self.pending_files = {}
+
+    def get_run_directory(self, path):
+        """
+        Returns the segmented run folder of a segment file or None
+        """
+        run_directory = os.path.dirname(path)
+        return run_directory if run_directory.endswith(SEGMENTED_RUN_SUFFIX) else None
+
+    def is_prediction_file(self, path):
+        """
+        Checks if the path is a prediction file
+        (<watershed>/<subbasin>/RapidResult_*_CF.nc) or a segment
+        (<watershed>/<subbasin>/<run>.segments/*.nc)
+        """
+        path_parts = os.path.relpath(os.path.abspath(path), self.prediction_directory).split(os.sep)
+        if len(path_parts) == 3:
+            return fnmatch(path_parts[2], 'RapidResult_*_CF.nc')
+        return len(path_parts) == 4 and path_parts[2].endswith(SEGMENTED_RUN_SUFFIX) \
+            and path_parts[3].endswith('.nc')
+
+    def find_files(self):
+        """
+        Returns all of the prediction files and segments
+        """
+        prediction_files = find_prediction_files(self.prediction_directory)
+        for run_directory in find_segmented_runs(self.prediction_directory):
+            prediction_files.extend(find_segment_files(run_directory))
+        return prediction_files
+
+    def scan(self, initial=False):
+        """
+        Notices new and changed files. On the first scan, files whose
+        sidecars are up to date count as handled.
+        """
+        for prediction_file in self.find_files():
+            if initial and sidecar_is_current(get_sidecar_path(prediction_file,
+                                                               REACH_INDEX_SUFFIX),
+                                              prediction_file):
+                self.handled_files[prediction_file] = get_file_signature(prediction_file)
+            elif get_file_signature(prediction_file) != self.handled_files.get(prediction_file):
+                self.notice(prediction_file)
+
+    def notice(self, path):
+        """
+        Adds a created, written or moved file to the pending files
+        """
+        path = os.path.abspath(path)
+        if self.is_prediction_file(path) and path not in self.pending_files:
+            self.pending_files[path] = (get_file_signature(path), time.time())
+
+    def process_pending(self):
+        """
+        Handles the pending files that did not change for settle_seconds
+        """
+        for path, (signature, since) in list(self.pending_files.items()):
+            current_signature = get_file_signature(path)
+            if current_signature is None:
+                #removed before it settled
+                del self.pending_files[path]
+                self.handled_files.pop(path, None)
+            elif current_signature != signature:
+                #still being written
+                self.pending_files[path] = (current_signature, time.time())
+            elif time.time() - since >= self.settle_seconds:
+                del self.pending_files[path]
+                if current_signature != self.handled_files.get(path):
+                    self.handle(path)
+                    self.handled_files[path] = current_signature
+
+    def handle(self, path):
+        """
+        Validates and ingests the file, then records it in the forecast
+        catalog or the segment index of its run
+        """
+        problem = validate_prediction_file(path)
+        if problem:
+            print("Skipping %s: %s" % (path, problem))
+            return
+        try:
+            built_files = ingest_prediction_file(path, self.memory_mb, raw_arrays=self.raw_arrays)
+            run_directory = self.get_run_directory(path)
+            if run_directory is not None:
+                segment_index, changed = build_segment_index(run_directory)
+                if changed:
+                    save_segment_index(run_directory, segment_index)
+            elif self.update_catalog:
+                try:
+                    update_forecast_catalog(self.prediction_directory, os.path.dirname(path))
+                except ImportError as ex:
+                    print("Forecast catalog not updated (run in the Tethys environment): %s" % ex)
+                    self.update_catalog = False
+            warm_page_cache([get_sidecar_path(path, suffix) for suffix in WARM_SIDECAR_SUFFIXES])
+        except Exception as ex:
+            print("Skipping %s: %s" % (path, ex))
+            return
+        print("Ingested %s (%d sidecars built)" % (path, len(built_files)))
+
+    def poll(self, poll_seconds=DEFAULT_POLL_SECONDS):
+        """
+        Scans the prediction directory every poll_seconds
+        """
+        print("Polling %s every %s seconds" % (self.prediction_directory, poll_seconds))
+        while True:
+            self.scan()
+            self.process_pending()
+            #look again soon while files are settling
+            time.sleep(min(poll_seconds, self.settle_seconds) if self.pending_files
+                       else poll_seconds)
+
+    def watch(self):
+        """
+        Waits for inotify events under the prediction directory
+        """
+        print("Watching %s with inotify" % self.prediction_directory)
+        watch_manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(watch_manager, PredictionEventHandler(watcher=self),
+                                      timeout=1000)
+        watch_manager.add_watch(self.prediction_directory,
+                                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                                pyinotify.IN_CREATE | pyinotify.IN_Q_OVERFLOW,
+                                rec=True, auto_add=True)
+        try:
+            while True:
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                self.process_pending()
+        finally:
+            notifier.stop()
+
+
+if pyinotify is not None:
+    class PredictionEventHandler(pyinotify.ProcessEvent):
+        """
+        Passes the inotify events to the prediction watcher
+        """
+        def my_init(self, watcher):
+            self.watcher = watcher
+
+        def process_IN_CLOSE_WRITE(self, event):
+            self.watcher.notice(event.pathname)
+
+        def process_IN_MOVED_TO(self, event):
+            self.watcher.notice(event.pathname)
+
+        def process_IN_CREATE(self, event):
+            #files copied into a new folder before it was watched
+            if event.dir:
+                self.watcher.scan()
+
+        def process_IN_Q_OVERFLOW(self, event):
+            #events were dropped
+            self.watcher.scan()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingests ADHydro prediction files as they are "
+                                                 "added to the prediction directory.")
+    parser.add_argument('prediction_directory', nargs='?',
+                        help="ADHydro prediction directory (default: from app settings)")
+    parser.add_argument('--settle-seconds', type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="Time a file must stay unchanged before it is ingested")
+    parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS,
+                        help="Time between scans when inotify is not available")
+    parser.add_argument('--poll', action='store_true',
+                        help="Poll even if inotify is available (e.g. on network file systems)")
+    parser.add_argument('--memory-mb', type=int, default=DEFAULT_INGEST_MEMORY_MB,
+                        help="Memory to use when transposing the output")
+    parser.add_argument('--raw-arrays', action='store_true',
+                        help="Also write uncompressed arrays for memory-mapped reads")
+    args = parser.parse_args()
+    watcher = PredictionWatcher(args.prediction_directory or get_prediction_directory(),
+                                args.settle_seconds, args.memory_mb, args.raw_arrays)
+    #files dropped while the watcher was not running
+    watcher.scan(initial=True)
+    if pyinotify is None or args.poll:
+        watcher.poll(args.poll_seconds)
+    else:
+        watcher.watch()